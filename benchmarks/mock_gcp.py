@@ -0,0 +1,400 @@
+""" Local stand-in for the GCP / Google Workspace endpoints used by DeleFriend: Resource Manager projects.list and
+getIamPolicy, IAM serviceAccounts.list/get/getIamPolicy, roles.get, keys.create/delete, the OAuth token endpoint and
+tokeninfo. It serves a synthetic org of configurable size and can inject latency and error rates """
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse, unquote
+
+OPERATOR_EMAIL = 'auditor@example.com'
+OPERATOR_TOKEN = 'mock-operator-token'
+DEFAULT_DWD_SCOPES = [
+    'https://www.googleapis.com/auth/admin.directory.user.readonly',
+    'https://mail.google.com/',
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/calendar',
+]
+ROLE_PERMISSIONS = {
+    'roles/owner': ['iam.serviceAccountKeys.create', 'iam.serviceAccountKeys.delete', 'iam.serviceAccounts.get',
+                    'resourcemanager.projects.get'],
+    'roles/editor': ['iam.serviceAccountKeys.create', 'iam.serviceAccountKeys.delete', 'iam.serviceAccounts.get'],
+    'roles/viewer': ['iam.serviceAccounts.get', 'resourcemanager.projects.get'],
+    'roles/iam.serviceAccountKeyAdmin': ['iam.serviceAccountKeys.create', 'iam.serviceAccountKeys.delete',
+                                         'iam.serviceAccountKeys.get', 'iam.serviceAccountKeys.list'],
+    'roles/iam.serviceAccountUser': ['iam.serviceAccounts.actAs', 'iam.serviceAccounts.get'],
+}
+MAX_KEYS_PER_SERVICE_ACCOUNT = 10
+KEY_POOL_SIZE = 4  # RSA key generation is slow, the mock hands out the same key pairs under distinct key IDs
+
+
+class SyntheticOrg:
+    """ Randomly generated (but seeded) org: projects, service accounts, IAM policies and DWD configuration """
+    def __init__(self, projects=10, service_accounts_per_project=5, key_permission_ratio=0.5, dwd_ratio=0.2,
+                 users_per_project=2, domains=1, dwd_scopes=None, seed=0, operator_email=OPERATOR_EMAIL):
+        rng = random.Random(seed)
+        self.operator_email = operator_email
+        self.domains = [f'org{index}.example.com' for index in range(domains)]
+        self.dwd_scopes = dwd_scopes or DEFAULT_DWD_SCOPES
+        self.projects = []
+        self.service_accounts = {}  # project ID -> accounts
+        self.accounts_by_email = {}
+        self.project_policies = {}
+        self.service_account_policies = {}
+        self.delegations = {}  # oauth2ClientId -> delegated scopes
+        self.lock = threading.Lock()
+        self.keys = {}  # key resource name -> service account email
+        self.tokens = {}  # access token -> (client email, subject, scope)
+
+        for project_index in range(projects):
+            project_id = f'mock-project-{project_index:05d}'
+            self.projects.append({'projectId': project_id, 'name': project_id, 'lifecycleState': 'ACTIVE',
+                                  'parent': {'type': 'organization', 'id': '1000'}})
+            members = [f'user:user{project_index}-{user}@{rng.choice(self.domains)}' for user in range(users_per_project)]
+            bindings = [{'role': 'roles/viewer', 'members': [f'user:{operator_email}'] + members}]
+            if rng.random() < key_permission_ratio / 2:
+                bindings.append({'role': 'roles/editor', 'members': [f'user:{operator_email}']})
+            self.project_policies[project_id] = {'etag': f'BwX{project_index:05d}', 'bindings': bindings}
+
+            accounts = []
+            for account_index in range(service_accounts_per_project):
+                email = f'sa-{account_index}@{project_id}.iam.gserviceaccount.com'
+                unique_id = str(100000000000000000000 + project_index * 1000 + account_index)
+                account = {'name': f'projects/{project_id}/serviceAccounts/{email}', 'projectId': project_id,
+                           'uniqueId': unique_id, 'email': email, 'oauth2ClientId': unique_id}
+                accounts.append(account)
+                self.accounts_by_email[email] = account
+                sa_bindings = []
+                if rng.random() < key_permission_ratio / 2:
+                    sa_bindings.append({'role': 'roles/iam.serviceAccountKeyAdmin', 'members': [f'user:{operator_email}']})
+                self.service_account_policies[account['name']] = {'etag': 'ACAB', 'bindings': sa_bindings}
+                if rng.random() < dwd_ratio:
+                    self.delegations[unique_id] = set(rng.sample(self.dwd_scopes, rng.randint(1, len(self.dwd_scopes))))
+            self.service_accounts[project_id] = accounts
+
+
+def generate_private_key_pem():
+    """ New RSA 2048 private key PEM, with cryptography or python-rsa (whichever google-auth was installed with) """
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError:
+        import rsa
+        _, private_key = rsa.newkeys(2048)
+        return private_key.save_pkcs1().decode('utf-8')
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption()).decode('utf-8')
+
+
+class KeyFactory:
+    """ Hands out RSA key pairs (PEM) from a small pool generated on first use """
+    def __init__(self, pool_size=KEY_POOL_SIZE):
+        self.pool_size = pool_size
+        self.pool = []
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def next_key(self):
+        with self.lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(generate_private_key_pem())
+            self.counter += 1
+            return f'{self.counter:040x}', self.pool[self.counter % len(self.pool)]
+
+
+def decode_jwt_payload(assertion):
+    payload = assertion.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload))
+
+
+class MockGCPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real endpoints
+
+    routes = [
+        ('GET', r'/crm/v1/projects', 'projects.list'),
+        ('POST', r'/crm/v1/projects/(?P<project>[^/:]+):getIamPolicy', 'projects.getIamPolicy'),
+        ('GET', r'/iam/v1/projects/(?P<project>[^/]+)/serviceAccounts', 'serviceAccounts.list'),
+        ('GET', r'/iam/v1/projects/(?P<project>[^/]+)/serviceAccounts/(?P<email>[^/:]+)', 'serviceAccounts.get'),
+        ('POST', r'/iam/v1/projects/(?P<project>[^/]+)/serviceAccounts/(?P<email>[^/:]+):getIamPolicy', 'serviceAccounts.getIamPolicy'),
+        ('GET', r'/iam/v1/(?P<role>(projects/[^/]+/)?roles/.+)', 'roles.get'),
+        ('POST', r'/iam/v1/projects/(?P<project>[^/]+)/serviceAccounts/(?P<email>[^/:]+)/keys', 'keys.create'),
+        ('DELETE', r'/iam/v1/(?P<key>projects/[^/]+/serviceAccounts/[^/]+/keys/[^/]+)', 'keys.delete'),
+        ('POST', r'/token', 'token'),
+        ('GET', r'/tokeninfo', 'tokeninfo'),
+        ('GET', r'/_stats', 'stats'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = unquote(url.path)
+        for route_method, pattern, endpoint in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                self.server.backend.handle(self, endpoint, match.groupdict())
+                return
+        self.respond(404, {'error': {'code': 404, 'message': f'Unknown endpoint {method} {path}', 'status': 'NOT_FOUND'}}, 'unknown')
+
+    def respond(self, status, payload, endpoint, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.backend.count(endpoint, status)
+
+
+class MockGCPBackend:
+    """ Request handling of the mock server, with latency and error injection and per-endpoint call counters """
+    def __init__(self, org, latency=0.0, jitter=0.0, error_rate=0.0, page_size=50, seed=0, quota=None):
+        self.org = org
+        self.quota = quota  # requests/s per endpoint before answering 429 RESOURCE_EXHAUSTED with Retry-After
+        self.quota_windows = {}  # endpoint -> (second, requests)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.rng = random.Random(seed)
+        self.key_factory = KeyFactory()
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.base_url = None
+
+    def count(self, endpoint, status):
+        with self.stats_lock:
+            self.stats[f'{endpoint} {status}'] += 1
+
+    def snapshot_stats(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def handle(self, handler, endpoint, params):
+        if endpoint == 'stats':
+            handler.respond(200, self.snapshot_stats(), 'stats')
+            return
+        delay = self.latency + (self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if self.over_quota(endpoint):
+            handler.respond(429, {'error': {'code': 429, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}},
+                            endpoint, headers={'Retry-After': '1'})
+            return
+        if self.error_rate and self.rng.random() < self.error_rate:
+            if self.rng.random() < 0.5:
+                handler.respond(429, {'error': {'code': 429, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}},
+                                endpoint)
+            else:
+                handler.respond(503, {'error': {'code': 503, 'message': 'The service is currently unavailable.', 'status': 'UNAVAILABLE'}},
+                                endpoint)
+            return
+        status, payload = getattr(self, 'handle_' + endpoint.replace('.', '_'))(handler, **params)
+        handler.respond(status, payload, endpoint)
+
+    def over_quota(self, endpoint):
+        if not self.quota:
+            return False
+        second = int(time.monotonic())
+        with self.stats_lock:
+            window, requests = self.quota_windows.get(endpoint, (second, 0))
+            if window != second:
+                window, requests = second, 0
+            self.quota_windows[endpoint] = (window, requests + 1)
+        return requests >= self.quota
+
+    def paginate(self, items, query, field):
+        page_size = min(int(query.get('pageSize') or self.page_size), self.page_size)
+        start = int(query.get('pageToken') or 0)
+        page = {field: items[start:start + page_size]}
+        if start + page_size < len(items):
+            page['nextPageToken'] = str(start + page_size)
+        return page
+
+    @staticmethod
+    def not_found(message):
+        return 404, {'error': {'code': 404, 'message': message, 'status': 'NOT_FOUND'}}
+
+    def handle_projects_list(self, handler):
+        projects = self.org.projects
+        filter_expression = handler.query.get('filter', '')
+        parent_id = re.search(r'parent\.id:(\S+)', filter_expression)
+        if parent_id:
+            projects = [project for project in projects if project['parent']['id'] == parent_id.group(1)]
+        return 200, self.paginate(projects, handler.query, 'projects')
+
+    def handle_projects_getIamPolicy(self, handler, project):
+        policy = self.org.project_policies.get(project)
+        return (200, policy) if policy else self.not_found(f'Project {project} not found')
+
+    def handle_serviceAccounts_list(self, handler, project):
+        if project not in self.org.service_accounts:
+            return self.not_found(f'Project {project} not found')
+        return 200, self.paginate(self.org.service_accounts[project], handler.query, 'accounts')
+
+    def handle_serviceAccounts_get(self, handler, project, email):
+        account = self.org.accounts_by_email.get(email)
+        return (200, account) if account else self.not_found(f'Service account {email} not found')
+
+    def handle_serviceAccounts_getIamPolicy(self, handler, project, email):
+        policy = self.org.service_account_policies.get(f'projects/{project}/serviceAccounts/{email}')
+        return (200, policy) if policy else self.not_found(f'Service account {email} not found')
+
+    def handle_roles_get(self, handler, role):
+        if role not in ROLE_PERMISSIONS:
+            return self.not_found(f'Role {role} not found')
+        return 200, {'name': role, 'includedPermissions': ROLE_PERMISSIONS[role]}
+
+    def handle_keys_create(self, handler, project, email):
+        account = self.org.accounts_by_email.get(email)
+        if account is None:
+            return self.not_found(f'Service account {email} not found')
+        with self.org.lock:
+            if sum(1 for owner in self.org.keys.values() if owner == email) >= MAX_KEYS_PER_SERVICE_ACCOUNT:
+                return 400, {'error': {'code': 400, 'message': 'Precondition check failed.', 'status': 'FAILED_PRECONDITION'}}
+            key_id, private_key = self.key_factory.next_key()
+            key_name = f"{account['name']}/keys/{key_id}"
+            self.org.keys[key_name] = email
+        key_file = {
+            'type': 'service_account', 'project_id': account['projectId'], 'private_key_id': key_id,
+            'private_key': private_key, 'client_email': email, 'client_id': account['oauth2ClientId'],
+            'auth_uri': 'https://accounts.google.com/o/oauth2/auth', 'token_uri': f'{self.base_url}/token',
+        }
+        private_key_data = base64.b64encode(json.dumps(key_file).encode('utf-8')).decode('ascii')
+        return 200, {'name': key_name, 'privateKeyType': 'TYPE_GOOGLE_CREDENTIALS_FILE', 'privateKeyData': private_key_data,
+                     'keyAlgorithm': 'KEY_ALG_RSA_2048'}
+
+    def handle_keys_delete(self, handler, key):
+        # the client builds the key resource name from the project ID, the SA email and the key ID
+        with self.org.lock:
+            if self.org.keys.pop(key, None) is None:
+                return self.not_found(f'Key {key} not found')
+        return 200, {}
+
+    def handle_token(self, handler):
+        form = {key: values[0] for key, values in parse_qs(handler.body.decode('utf-8')).items()}
+        try:
+            claims = decode_jwt_payload(form['assertion'])
+        except (KeyError, IndexError, ValueError):
+            return 400, {'error': 'invalid_request', 'error_description': 'Invalid JWT'}
+        account = self.org.accounts_by_email.get(claims.get('iss'))
+        if account is None:
+            return 400, {'error': 'invalid_grant', 'error_description': 'Invalid JWT Signature.'}
+        subject, scope = claims.get('sub'), claims.get('scope', '')
+        if subject and subject.split('@')[-1] not in self.org.domains:
+            return 400, {'error': 'invalid_grant', 'error_description': 'Invalid email or User ID'}
+        delegated = self.org.delegations.get(account['oauth2ClientId'], set())
+        if subject and not set(scope.split()) <= delegated:
+            return 401, {'error': 'unauthorized_client',
+                         'error_description': 'Client is unauthorized to retrieve access tokens using this method, '
+                                              'or client not authorized for any of the scopes requested.'}
+        access_token = f'ya29.mock-{self.rng.getrandbits(64):016x}'
+        with self.org.lock:
+            self.org.tokens[access_token] = (account['email'], subject, scope)
+        return 200, {'access_token': access_token, 'expires_in': 3599, 'token_type': 'Bearer'}
+
+    def handle_tokeninfo(self, handler):
+        authorization = handler.headers.get('Authorization', '')
+        if authorization == f'Bearer {OPERATOR_TOKEN}':
+            return 200, {'email': self.org.operator_email, 'verified_email': True, 'expires_in': 3599}
+        token = self.org.tokens.get(handler.query.get('access_token'))
+        if token is None:
+            return 400, {'error': 'invalid_token', 'error_description': 'Invalid Value'}
+        client_email, subject, scope = token
+        return 200, {'issued_to': self.org.accounts_by_email[client_email]['oauth2ClientId'], 'scope': scope,
+                     'email': subject, 'expires_in': 3599}
+
+
+class MockGCPServer:
+    """ Threaded HTTP server serving a MockGCPBackend, usable as a context manager """
+    def __init__(self, backend, host='127.0.0.1', port=0):
+        self.backend = backend
+        self.httpd = ThreadingHTTPServer((host, port), MockGCPHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.backend = backend
+        self.base_url = f'http://{host}:{self.httpd.server_address[1]}'
+        backend.base_url = self.base_url
+        self.thread = None
+
+    def config(self):
+        """ config.yaml parameters pointing DeleFriend at this server """
+        return {
+            'bearer_access_token': OPERATOR_TOKEN,
+            'api_endpoints': {'cloudresourcemanager': f'{self.base_url}/crm/', 'iam': f'{self.base_url}/iam/'},
+            'tokeninfo_url': f'{self.base_url}/tokeninfo',
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def add_org_arguments(parser):
+    parser.add_argument('--projects', type=int, default=10, help="Number of synthetic projects (default: %(default)s)")
+    parser.add_argument('--service-accounts', type=int, default=5, help="Service accounts per project (default: %(default)s)")
+    parser.add_argument('--key-permission-ratio', type=float, default=0.5, help="Ratio of SAs on which the operator can create keys (default: %(default)s)")
+    parser.add_argument('--dwd-ratio', type=float, default=0.2, help="Ratio of SAs with domain-wide delegation (default: %(default)s)")
+    parser.add_argument('--domains', type=int, default=1, help="Number of Workspace domains (default: %(default)s)")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Injected latency per request (default: %(default)s)")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="Random +/- latency jitter (default: %(default)s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Ratio of requests answered with 429/503 (default: %(default)s)")
+    parser.add_argument('--quota', type=float, default=None, help="Requests/s per endpoint before answering 429 with Retry-After (default: unlimited)")
+    parser.add_argument('--page-size', type=int, default=50, help="Maximum list page size (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the synthetic org (default: %(default)s)")
+
+
+def backend_from_args(args):
+    org = SyntheticOrg(projects=args.projects, service_accounts_per_project=args.service_accounts,
+                       key_permission_ratio=args.key_permission_ratio, dwd_ratio=args.dwd_ratio, domains=args.domains,
+                       seed=args.seed)
+    return MockGCPBackend(org, latency=args.latency_ms / 1000.0, jitter=args.jitter_ms / 1000.0,
+                          error_rate=args.error_rate, page_size=args.page_size, seed=args.seed, quota=args.quota)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DeleFriend mock GCP/Workspace backend")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    add_org_arguments(parser)
+    args = parser.parse_args()
+    server = MockGCPServer(backend_from_args(args), host=args.host, port=args.port)
+    print("[+] Mock GCP backend listening, add the following parameters to the DeleFriend config YAML:\n")
+    for name, value in server.config().items():
+        print(f"{name}: {json.dumps(value)}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
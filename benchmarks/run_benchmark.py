@@ -0,0 +1,132 @@
+""" Benchmark the main.py stages against the local mock GCP backend: API calls, wall time and peak memory per stage.
+
+    python -m benchmarks.run_benchmark --projects 200 --service-accounts 10 --latency-ms 30 --json bench.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from google.auth.credentials import Credentials
+
+from benchmarks.mock_gcp import MockGCPServer, add_org_arguments, backend_from_args
+from src.domain_users_enum import DomainUserEnumerator
+from src.enumeration_engine import DEFAULT_WORKERS
+from src.gcp_sa_enum import ServiceAccountEnumerator
+from src.oauth_scope_enumrator import OAuthEnumerator, DEFAULT_VALIDATION_WORKERS, SEARCH_MODES, SEARCH_MODE_FULL, VALIDATION_MODES, VALIDATION_MODE_EXCHANGE
+from src.assertion_signer import DEFAULT_SIGNING_PROCESSES
+from src.role_cache import RolePermissionCache
+from src.transport import Transport
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCOPES_FILE = os.path.join(REPO_ROOT, 'src', 'oauth_scopes.txt')
+
+
+class BearerCredentials(Credentials):
+    """ Same static bearer token credentials as main.CustomCredentials """
+    def __init__(self, token):
+        self.token = token
+
+    def apply(self, headers):
+        headers['Authorization'] = f'Bearer {self.token}'
+
+    def before_request(self, request, method, url, headers):
+        self.apply(headers)
+
+    def refresh(self, request):
+        pass
+
+
+class StageRecorder:
+    """ Record the wall time, mock API calls and peak traced memory of each stage """
+    def __init__(self, backend):
+        self.backend = backend
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        calls_before = Counter(self.backend.snapshot_stats())
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - started_at
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            calls = Counter(self.backend.snapshot_stats())
+            calls.subtract(calls_before)
+            calls = {endpoint: count for endpoint, count in sorted(calls.items()) if count}
+            self.stages.append({'stage': name, 'wall_time': round(wall_time, 4), 'calls': calls,
+                                'total_calls': sum(calls.values()), 'peak_memory_bytes': peak_memory})
+
+    def print_summary(self):
+        print(f"\n{'stage':<16}{'wall (s)':>10}{'API calls':>11}{'peak MiB':>10}")
+        for stage in self.stages:
+            print(f"{stage['stage']:<16}{stage['wall_time']:>10.2f}{stage['total_calls']:>11}{stage['peak_memory_bytes'] / 2 ** 20:>10.2f}")
+            for endpoint, count in stage['calls'].items():
+                print(f"    {endpoint:<40}{count:>7}")
+
+
+def limited_scopes_file(directory, limit):
+    """ Copy of oauth_scopes.txt with only the first scopes, to size the JWT combination space """
+    with open(SCOPES_FILE, 'r') as file:
+        scopes = [line.strip() for line in file if line.strip()]
+    path = os.path.join(directory, 'oauth_scopes.txt')
+    with open(path, 'w') as file:
+        file.write('\n'.join(scopes[:limit]) + '\n')
+    return path
+
+
+def run_benchmark(args):
+    backend = backend_from_args(args)
+    recorder = StageRecorder(backend)
+    with MockGCPServer(backend) as server, tempfile.TemporaryDirectory() as work_dir:
+        config = server.config()
+        scopes_file = limited_scopes_file(work_dir, args.scopes) if args.scopes else SCOPES_FILE
+        previous_dir = os.getcwd()
+        os.chdir(work_dir)  # the key manifest and journal paths are relative to the working directory
+        try:
+            credentials = BearerCredentials(config['bearer_access_token'])
+            transport = Transport(credentials, pool_size=max(args.workers, args.validation_workers), max_per_host=args.workers,
+                                  api_endpoints=config['api_endpoints'], tokeninfo_url=config['tokeninfo_url'])
+            with recorder.stage('enumeration'):
+                enumerator = ServiceAccountEnumerator(credentials, role_cache=RolePermissionCache(), max_workers=args.workers,
+                                                      transport=transport, page_size=args.page_size)
+                enumerator.enumerate_service_accounts()
+            with recorder.stage('domain_users'):
+                DomainUserEnumerator(enumerator).list_unique_domain_users()
+            with recorder.stage('validation'):
+                oauth_enumerator = OAuthEnumerator(enumerator, None, scopes_file, max_workers=args.validation_workers,
+                                                   search_mode=args.search_mode, signing_processes=args.signing_processes,
+                                                   validation_mode=args.validation_mode)
+                oauth_enumerator.run()
+                oauth_enumerator.results_writer.close(oauth_enumerator.scopes)
+            with recorder.stage('cleanup'):
+                enumerator.key_creator.delete_keys_without_dwd(oauth_enumerator.confirmed_dwd_keys)
+        finally:
+            os.chdir(previous_dir)
+
+    recorder.print_summary()
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'parameters': vars(args), 'stages': recorder.stages}, file, indent=2)
+        print(f"\n[+] Benchmark results saved to {args.json}")
+    return recorder.stages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DeleFriend offline benchmark")
+    add_org_arguments(parser)
+    parser.add_argument('--scopes', type=int, default=20, help="Number of scopes from oauth_scopes.txt to test, 0 for all (default: %(default)s)")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--validation-workers', type=int, default=DEFAULT_VALIDATION_WORKERS)
+    parser.add_argument('--signing-processes', type=int, default=DEFAULT_SIGNING_PROCESSES)
+    parser.add_argument('-m', '--search-mode', choices=SEARCH_MODES, default=SEARCH_MODE_FULL)
+    parser.add_argument('--validation-mode', choices=VALIDATION_MODES, default=VALIDATION_MODE_EXCHANGE)
+    parser.add_argument('--json', type=str, default=None, help="Save the per-stage results as JSON")
+    run_benchmark(parser.parse_args())
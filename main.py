@@ -6,25 +6,48 @@ from googleapiclient.errors import HttpError
 from google.auth.exceptions import RefreshError
 from src import oauth_scope_enumrator
 from src.domain_users_enum import DomainUserEnumerator
+from src.role_cache import RolePermissionCache, DEFAULT_TTL
+from src.enumeration_engine import DEFAULT_WORKERS
+from src.oauth_scope_enumrator import DEFAULT_VALIDATION_WORKERS, SEARCH_MODES, SEARCH_MODE_FULL, VALIDATION_MODES, VALIDATION_MODE_EXCHANGE
+from src.assertion_signer import DEFAULT_SIGNING_PROCESSES
+from src.transport import Transport, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, TOKENINFO_URL as DEFAULT_TOKENINFO_URL
+from src.journal import ProgressJournal, DEFAULT_JOURNAL_FILE
+from src.audit_snapshot import AuditSnapshot, DEFAULT_AUDIT_SNAPSHOT_FILE
+from src.results_writer import ResultsWriter, RESULTS_FORMATS
+from src.private_key_creator import DEFAULT_KEY_MANIFEST_FILE
+from src.key_store import KeyStore, KEY_STORAGE_MEMORY, KEY_STORAGE_ENCRYPTED
+from src.metrics import Metrics, ThreadProfiler
 import os
-import time
-
-
-parser = argparse.ArgumentParser(description="DeleFriend Tool")
-parser.add_argument('-c', '--config', type=str, required=True, help="Path to the GCP IAM configuration file")
-parser.add_argument('-v', '--verbose', action='store_true', help="Enable verbose/debugging mode")
-args = parser.parse_args()
-# load configuration
-with open(args.config, 'r') as file:
-    config = yaml.safe_load(file)
-
-BEARER_ACCESS_TOKEN = config.get('bearer_access_token')
-WORKSPACE_USER_EMAIL = config.get('workspace_user_email')
+import getpass
 
+SCOPES_PRIORITY_FILE = 'src/oauth_scopes_priority.txt'  # most commonly delegated scopes first
 SCOPES_FILE = 'src/oauth_scopes.txt'  #  scopes file
 KEY_FOLDER = 'SA_private_keys'
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="DeleFriend Tool")
+    parser.add_argument('-c', '--config', type=str, required=True, help="Path to the GCP IAM configuration file")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Enable verbose/debugging mode")
+    parser.add_argument('--validation-workers', type=int, default=DEFAULT_VALIDATION_WORKERS, help="Number of concurrent JWT validation threads (default: %(default)s)")
+    parser.add_argument('--signing-processes', type=int, default=DEFAULT_SIGNING_PROCESSES,
+                        help="Number of processes pre-signing the JWT assertions, 0 to sign them in the validation threads (default: %(default)s)")
+    parser.add_argument('-m', '--search-mode', choices=SEARCH_MODES, default=SEARCH_MODE_FULL,
+                        help="full: collect every valid scope of each key, confirm: stop testing a key after its first valid scope (default: %(default)s)")
+    parser.add_argument('--validation-mode', choices=VALIDATION_MODES, default=VALIDATION_MODE_EXCHANGE,
+                        help="exchange: decide DWD from the token exchange response alone, tokeninfo: also confirm the granted scope of each issued token (default: %(default)s)")
+    parser.add_argument('--scopes-priority', type=str, default=None, nargs='?', const=SCOPES_PRIORITY_FILE,
+                        help=f"Try the scopes in the ranked order of a priority file first (default file: {SCOPES_PRIORITY_FILE})")
+    parser.add_argument('--journal', type=str, default=DEFAULT_JOURNAL_FILE, help="Path of the progress journal (default: %(default)s)")
+    parser.add_argument('--resume', action='store_true', help="Resume an interrupted run from the progress journal, skipping the completed work")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Re-audit incrementally from the snapshot of the previous run: the enumeration runs in full and keys are only created and tested for the new service accounts, subjects and scopes")
+    parser.add_argument('--metrics', type=str, default=None, metavar='PATH', help="Show a live metrics summary and export the API call and stage metrics as JSON to PATH")
+    parser.add_argument('--profile', type=str, default=None, metavar='PATH', help="Save a cProfile dump of the run to PATH (e.g. to spot RSA signing CPU time)")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help="Number of concurrent API worker threads (default: %(default)s)")
+    return parser.parse_args()
+
+
 class CustomCredentials(Credentials):
 
     def __init__(self, token):
@@ -40,25 +63,12 @@ class CustomCredentials(Credentials):
         pass
 
 
-def results():
-    timestamp = int(time.time())
-    result_folder = 'results'
-    if not os.path.exists(result_folder):
-        os.makedirs(result_folder)
-
-    filename = f'results_{timestamp}.txt'
-    filepath = os.path.join(result_folder, filename)
-    print(f"\n\n[+] Saving results to results/{filename} ...")
-
-    with open(filepath, 'w') as f:
-        valid_results = oauth_scope_enumrator.get_valid_results()
-        for json_path, valid_scopes in valid_results.items():
-            if valid_scopes:
-                f.write(f'Service Account Key Name: {os.path.basename(json_path)}\n')
-                f.write('Valid OAuth Scopes:\n')
-                for scope in valid_scopes:
-                    f.write(f'{scope}\n')
-                f.write('---\n')
+def results(results_writer, scopes):
+    """ Close the streamed findings and write the indexed summary and the text report """
+    summary = results_writer.close(scopes)
+    totals = summary['totals']
+    print(f"[+] {totals['findings']} DWD findings: {totals['service_accounts']} service accounts in {totals['projects']} projects, "
+          f"{totals['domains']} domains and {totals['scopes']} scopes")
 
 
 def info():
@@ -70,27 +80,97 @@ def info():
                          By Axon - Hunters.security""")
 
 
-if __name__ == "__main__":
+def main():
+    args = parse_args()
+    # load configuration (spawned signing processes import this module, only the __main__ run reads it)
+    with open(args.config, 'r') as file:
+        config = yaml.safe_load(file)
+
+    bearer_access_token = config.get('bearer_access_token')
+    workspace_user_email = config.get('workspace_user_email')
+    role_cache_file = config.get('role_cache_file', '.cache/role_permissions.json')
+    role_cache_ttl = config.get('role_cache_ttl', DEFAULT_TTL)
+    max_concurrency_per_host = config.get('max_concurrency_per_host')
+    http_pool_size = config.get('http_pool_size', DEFAULT_POOL_SIZE)
+    http_timeout = config.get('http_timeout', DEFAULT_TIMEOUT)
+    api_endpoints = config.get('api_endpoints')  # e.g. the local mock backend of benchmarks/mock_gcp.py
+    tokeninfo_url = config.get('tokeninfo_url', DEFAULT_TOKENINFO_URL)
+    rate_limits = config.get('rate_limits')
+    page_size = config.get('page_size')
+    project_filter = config.get('project_filter')
+    project_parent = config.get('project_parent')
+    key_manifest_file = config.get('key_manifest_file', DEFAULT_KEY_MANIFEST_FILE)
+    audit_snapshot_file = config.get('audit_snapshot_file', DEFAULT_AUDIT_SNAPSHOT_FILE)
+    results_formats = config.get('results_formats', RESULTS_FORMATS)
+    key_storage = config.get('key_storage', KEY_STORAGE_MEMORY)
+    key_store_passphrase = config.get('key_store_passphrase') or os.environ.get('DELEFRIEND_KEY_PASSPHRASE')
+
+    metrics = Metrics()
+    profiler = ThreadProfiler() if args.profile else None
+    if profiler:
+        profiler.start()
+    if args.metrics:
+        metrics.start_live_summary()
     try:
         info()
-        credentials = CustomCredentials(BEARER_ACCESS_TOKEN)
-        enumerator = ServiceAccountEnumerator(credentials, verbose=args.verbose)
+        credentials = CustomCredentials(bearer_access_token)
+        journal = ProgressJournal(args.journal, resume=args.resume)
+        role_cache = RolePermissionCache(role_cache_file, ttl=role_cache_ttl)
+        passphrase = key_store_passphrase
+        if key_storage == KEY_STORAGE_ENCRYPTED and not passphrase:
+            passphrase = getpass.getpass("[+] Passphrase of the encrypted key store: ")
+        key_store = KeyStore(key_storage, KEY_FOLDER, passphrase=passphrase)
+        audit = AuditSnapshot(audit_snapshot_file, incremental=args.incremental)
+        transport = Transport(credentials, pool_size=max(http_pool_size, args.validation_workers), timeout=http_timeout,
+                              max_per_host=max_concurrency_per_host or args.workers,
+                              api_endpoints=api_endpoints, tokeninfo_url=tokeninfo_url, metrics=metrics,
+                              rate_limits=rate_limits)
+        enumerator = ServiceAccountEnumerator(credentials, verbose=args.verbose, role_cache=role_cache,
+                                              max_workers=args.workers, transport=transport,
+                                              page_size=page_size, project_filter=project_filter, project_parent=project_parent,
+                                              journal=journal, key_manifest_file=key_manifest_file, key_store=key_store,
+                                              audit=audit)
+        # the created keys without confirmed DWD are deleted even if the run is interrupted
+        enumerator.key_creator.install_exit_cleanup()
         print("\n[+] Enumerating GCP Resources: Projects and Service Accounts...")
-        enumerator.enumerate_service_accounts()
-
-        domain_user_enumerator = DomainUserEnumerator(enumerator)
-        print("\n[+] Enumerating unique org domain and users on GCP (ONE user per domain) ...")
-        domain_user_enumerator.print_unique_domain_users()
-
-        oauth_scope_enumrator = oauth_scope_enumrator.OAuthEnumerator(enumerator, WORKSPACE_USER_EMAIL, SCOPES_FILE, KEY_FOLDER, verbose=args.verbose)
+        with metrics.stage('enumeration', current=True):
+            enumerator.enumerate_service_accounts()
+        role_cache.save()
+
+        with metrics.stage('domain_users', current=True):
+            domain_user_enumerator = DomainUserEnumerator(enumerator)
+            print("\n[+] Enumerating unique org domain and users on GCP (ONE user per domain) ...")
+            domain_user_enumerator.print_unique_domain_users()
+
+            results_writer = ResultsWriter(formats=results_formats, key_files=key_store.persistent)
+            oauth_enumerator = oauth_scope_enumrator.OAuthEnumerator(enumerator, workspace_user_email, SCOPES_FILE, verbose=args.verbose,
+                                                                        max_workers=args.validation_workers, priority_file=args.scopes_priority,
+                                                                        journal=journal, signing_processes=args.signing_processes,
+                                                                        validation_mode=args.validation_mode, results_writer=results_writer)
         print("\n[+] Enumerating OAuth scopes and private key access tokens... (it might take a while based on the number of the JWT combinations) ")
-        oauth_scope_enumrator.run()
-        confirmed_dwd_keys = oauth_scope_enumrator.confirmed_dwd_keys
-        enumerator.key_creator.delete_keys_without_dwd(confirmed_dwd_keys)
-
-        results()
+        with metrics.stage('validation', current=True):
+            oauth_enumerator.run(search_mode=args.search_mode)
+        confirmed_dwd_keys = oauth_enumerator.confirmed_dwd_keys
+        with metrics.stage('cleanup', current=True):
+            enumerator.key_creator.delete_keys_without_dwd(confirmed_dwd_keys)
+
+        results(results_writer, oauth_enumerator.scopes)
+        audit.save()
+        journal.close()
+        enumerator.key_creator.close()
     except HttpError as e:
         if e.resp.status == 401 and b"ACCESS_TOKEN_TYPE_UNSUPPORTED" in e.content:
             print("\nThe provided Bearer access token isn't valid. Refresh a new one.")
         else:
-            print(f"An error occurred: {e}")
\ No newline at end of file
+            print(f"An error occurred: {e}")
+    finally:
+        if args.metrics:
+            metrics.stop_live_summary()
+            metrics.print_summary()
+            metrics.export(args.metrics)
+        if profiler:
+            profiler.dump(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from google.auth import crypt, jwt
+from google.oauth2 import _client
+
+DEFAULT_SIGNING_PROCESSES = os.cpu_count() if (os.cpu_count() or 1) > 1 else 0  # a single core gains nothing from a process pool
+DEFAULT_BATCH_SIZE = 64  # combinations signed per task, amortizes the inter-process round-trip
+ASSERTION_LIFETIME = 3600  # seconds, same as google.oauth2.service_account.Credentials
+TOKEN_AUDIENCE = 'https://oauth2.googleapis.com/token'  # audience of the assertions regardless of the key token_uri
+
+worker_signers = {}  # key path -> RSASigner, loaded once per signing process
+
+
+def init_worker(keys):
+    """ Load the RSA signers of all the keys (key path -> (PEM private key, private key ID)) in the signing process """
+    for key_path, (private_key, private_key_id) in keys.items():
+        worker_signers[key_path] = crypt.RSASigner.from_string(private_key, private_key_id)
+
+
+def sign_batch(batch):
+    """ Sign the assertions of a batch of (key path, client email, subject, scope), returns them with the signing time """
+    started_at = time.perf_counter()
+    now = int(time.time())
+    assertions = []
+    for key_path, client_email, subject, scope in batch:
+        payload = {'iat': now, 'exp': now + ASSERTION_LIFETIME, 'iss': client_email, 'aud': TOKEN_AUDIENCE, 'scope': scope}
+        if subject:
+            payload['sub'] = subject
+        assertions.append(jwt.encode(worker_signers[key_path], payload))
+    return assertions, time.perf_counter() - started_at
+
+
+class SignedAssertion:
+    """ Pre-signed JWT assertion exchanged like service_account.Credentials.refresh, without signing in the network worker """
+    __slots__ = ('token_uri', 'assertion', 'token')
+
+    def __init__(self, token_uri, assertion):
+        self.token_uri = token_uri
+        self.assertion = assertion
+        self.token = None
+
+    def refresh(self, request):
+        # transient errors are retried by the caller only, google-auth would retry them again on top of that
+        self.token, _, _ = _client.jwt_grant(request, self.token_uri, self.assertion, can_retry=False)
+
+
+class AssertionSigner:
+    """ Process pool pre-signing the JWT assertions of upcoming (key, subject, scope) combinations, so that RSA signing
+    scales across cores instead of running under the GIL of the validation threads """
+    def __init__(self, records, processes=DEFAULT_SIGNING_PROCESSES, metrics=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.processes = max(1, processes)
+        self.metrics = metrics
+        self.batch_size = batch_size
+        keys = {record.key_path: (record.private_key, record.private_key_id) for record in records}
+        # spawn: forking a process which runs HTTP worker threads isn't safe
+        self.pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=init_worker, initargs=(keys,))
+
+    def batches(self, combinations):
+        batch = []
+        for combination in combinations:
+            batch.append(combination)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def submit(self, batch, skipped):
+        return self.pool.submit(sign_batch, [(record.key_path, record.client_email, subject, scope)
+                                             for (record, subject, scope), skip in zip(batch, skipped) if not skip])
+
+    def collect(self, batch, skipped, future):
+        assertions, seconds = future.result()
+        if self.metrics is not None:
+            self.metrics.add_stage_time('jwt_signing', seconds)
+        assertions = iter(assertions)
+        for (record, subject, scope), skip in zip(batch, skipped):
+            yield record.key_path, subject, scope, None if skip else SignedAssertion(record.token_uri, next(assertions))
+
+    def sign(self, combinations, skip=None):
+        """ Lazily yield (key path, subject, scope, SignedAssertion) for the (KeyRecord, subject, scope) combinations, in order.
+        Combinations for which skip(key path, subject, scope) is true aren't signed and come with None.
+        At most two batches per process are signed ahead of the consumer """
+        pending = deque()
+        for batch in self.batches(combinations):
+            skipped = [skip is not None and skip(record.key_path, subject, scope) for record, subject, scope in batch]
+            pending.append((batch, skipped, self.submit(batch, skipped)))
+            if len(pending) >= self.processes * 2:
+                yield from self.collect(*pending.popleft())
+        while pending:
+            yield from self.collect(*pending.popleft())
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+
+DEFAULT_AUDIT_SNAPSHOT_FILE = 'results/audit_snapshot.json'
+
+
+class AuditSnapshot:
+    """ DWD results of the previous run reused by an incremental re-audit, and the results of the current run saved for the next one.
+    The enumeration always runs in full (IAM changes must be seen), the results are keyed by service account and client ID
+    (DWD is granted to the client ID in Workspace, IAM changes don't affect it), so only new service accounts, subjects and
+    scopes need a key and are tested again. The results are held as bitsets over the scope indexes (tested, valid)
+    per service account and subject """
+    def __init__(self, snapshot_file=DEFAULT_AUDIT_SNAPSHOT_FILE, incremental=False):
+        self.snapshot_file = snapshot_file
+        self.lock = threading.Lock()
+        self.previous = {'dwd': {}}
+        self.dwd = {}  # service account name -> {'client_id', 'results': {subject: [tested scopes bitset, valid scopes bitset]}}
+        self.scope_indexes = {}  # scope -> bit index in the DWD results bitsets
+        self.scope_names = []
+        if incremental:
+            self.load()
+
+    def scope_bit(self, scope, add=True):
+        """ Bit of the scope in the DWD results bitsets, 0 for an unknown scope when add is false """
+        index = self.scope_indexes.get(scope)
+        if index is None:
+            if not add:
+                return 0
+            with self.lock:
+                index = self.scope_indexes.setdefault(scope, len(self.scope_names))
+                if index == len(self.scope_names):
+                    self.scope_names.append(scope)
+        return 1 << index
+
+    def scopes_of(self, bits):
+        return [scope for index, scope in enumerate(self.scope_names) if bits >> index & 1]
+
+    def load(self):
+        if not os.path.exists(self.snapshot_file):
+            print(f"\033[93m [!] No audit snapshot found at {self.snapshot_file}, running a full audit \033[0m")
+            return
+        try:
+            with open(self.snapshot_file, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"\033[91m [!] Ignoring unreadable audit snapshot {self.snapshot_file}: {e} \033[0m")
+            return
+        dwd = {}
+        for name, entry in data.get('dwd', {}).items():
+            results = {}
+            for subject, scopes in entry.get('results', {}).items():
+                valid = sum(self.scope_bit(scope) for scope in set(scopes.get('valid', [])))
+                invalid = sum(self.scope_bit(scope) for scope in set(scopes.get('invalid', [])))
+                results[subject] = [valid | invalid, valid]
+            dwd[name] = {'client_id': entry.get('client_id'), 'results': results}
+        self.previous = {'dwd': dwd}
+        print(f"[+] Incremental audit from {self.snapshot_file} ({time.strftime('%Y-%m-%d %H:%M', time.localtime(data.get('created_at', 0)))}): "
+              f"{len(dwd)} service accounts DWD results")
+
+    def previous_dwd(self, account):
+        """ DWD results of the previous run (subject -> [tested bitset, valid bitset]) if the service account still has the same client ID """
+        entry = self.previous['dwd'].get(account['name'])
+        if entry is None or entry['client_id'] != account.get('oauth2ClientId'):
+            return None
+        return entry['results']
+
+    def covers(self, account, subjects, scopes, confirm=False):
+        """ Whether the previous run tested all the subject and scope combinations of the service account. In confirm mode
+        (testing stops at the first valid scope) a valid result for any of the subjects and scopes covers it """
+        results = self.previous_dwd(account)
+        if results is None:
+            return False
+        if confirm:
+            wanted = sum(self.scope_bit(scope, add=False) for scope in set(scopes))
+            if any(results.get(subject, (0, 0))[1] & wanted for subject in subjects):
+                return True
+        required = 0
+        for scope in scopes:
+            bit = self.scope_bit(scope, add=False)
+            if not bit:
+                return False  # never tested by the previous run
+            required |= bit
+        return all(results.get(subject, (0, 0))[0] & required == required for subject in subjects)
+
+    def track_service_account(self, account):
+        """ Start the DWD results of a service account with key permission from the reusable results of the previous run """
+        previous = self.previous_dwd(account) or {}
+        with self.lock:
+            self.dwd[account['name']] = {'client_id': account.get('oauth2ClientId'),
+                                         'results': {subject: list(bits) for subject, bits in previous.items()}}
+
+    def get_result(self, service_account, subject, scope):
+        """ True/False when the combination is already known for the service account, None otherwise """
+        bit = self.scope_bit(scope, add=False)
+        with self.lock:
+            entry = self.dwd.get(service_account)
+            tested, valid = entry['results'].get(subject, (0, 0)) if entry is not None else (0, 0)
+        if not tested & bit:
+            return None
+        return bool(valid & bit)
+
+    def record_result(self, service_account, subject, scope, valid):
+        bit = self.scope_bit(scope)
+        with self.lock:
+            entry = self.dwd.setdefault(service_account, {'client_id': None, 'results': {}})
+            bits = entry['results'].setdefault(subject, [0, 0])
+            bits[0] |= bit
+            if valid:
+                bits[1] |= bit
+
+    def valid_results(self, service_account):
+        """ subject -> valid scopes known for the service account """
+        with self.lock:
+            entry = self.dwd.get(service_account)
+            if entry is None:
+                return {}
+            return {subject: self.scopes_of(valid) for subject, (_, valid) in entry['results'].items()}
+
+    def save(self):
+        """ Save the snapshot for the next incremental run, service accounts not seen by this run are carried over """
+        with self.lock:
+            dwd = dict(self.previous['dwd'])
+            dwd.update(self.dwd)
+            data = {
+                'created_at': int(time.time()),
+                'dwd': {name: {'client_id': entry['client_id'],
+                               'results': {subject: {'valid': sorted(self.scopes_of(valid)),
+                                                     'invalid': sorted(self.scopes_of(tested & ~valid))}
+                                           for subject, (tested, valid) in entry['results'].items()}}
+                        for name, entry in dwd.items()},
+            }
+        directory = os.path.dirname(self.snapshot_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.snapshot_file + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.snapshot_file)
+        print(f"[+] Saving the audit snapshot to {self.snapshot_file} ...")
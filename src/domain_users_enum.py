@@ -8,21 +8,16 @@ class DomainUserEnumerator:
         """List unique domain users across projects (excluding service accounts)"""
         unique_domains = {}
         for project_id in self.gcp_project_enumerator.get_projects():
-            resource_manager_service = self.gcp_project_enumerator.resource_manager_service
-            request = resource_manager_service.projects().getIamPolicy(resource=project_id, body={})
-            response = request.execute()
-
-            if 'bindings' in response:
-                for binding in response['bindings']:
-                    if 'members' in binding:
-                        for member in binding['members']:
-                            if member.startswith('user:'):
-                                email = member.split(':')[1]
-                                # exclude GCP service accounts
-                                if '@' in email and not email.endswith('.gserviceaccount.com'):
-                                    domain = email.split('@')[1]
-                                    if domain not in unique_domains:
-                                        unique_domains[domain] = email
+            # project IAM policies are fetched once per run and shared with the service account enumerator
+            policy = self.gcp_project_enumerator.snapshot.project_policy(project_id)
+            for member in policy.roles_by_member:
+                if member.startswith('user:'):
+                    email = member.split(':')[1]
+                    # exclude GCP service accounts
+                    if '@' in email and not email.endswith('.gserviceaccount.com'):
+                        domain = email.split('@')[1]
+                        if domain not in unique_domains:
+                            unique_domains[domain] = email
         return unique_domains
 
 
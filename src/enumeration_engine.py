@@ -0,0 +1,98 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 8
+
+
+class EnumerationEngine:
+    """ Fan out the project serviceAccounts().list / getIamPolicy and per-SA getIamPolicy calls to a bounded worker pool
+    and stream the results back through a queue in deterministic (project, service account) order """
+    def __init__(self, gcp_project_enumerator, max_workers=DEFAULT_WORKERS):
+        self.gcp_project_enumerator = gcp_project_enumerator
+        self.max_workers = max(1, max_workers)
+        self.results = queue.Queue()
+        self.stopped = threading.Event()
+
+    def submit_projects(self, project_ids, pool):
+        """ Submit a project scan for each project as soon as its page of the project list arrives """
+        count = 0
+        error = None
+        try:
+            for project_id in project_ids:
+                if self.stopped.is_set():
+                    break
+                pool.submit(self.scan_project, count, project_id, pool)
+                count += 1
+        except Exception as e:
+            error = e
+        self.results.put((None, (count, error)))
+
+    def scan_project(self, index, project_id, pool):
+        """ Stream the project service accounts and fan out the per-SA checks """
+        count = 0
+        try:
+            for account in self.gcp_project_enumerator.list_service_accounts(project_id):
+                if self.stopped.is_set():
+                    return
+                pool.submit(self.scan_service_account, index, count, project_id, account)
+                count += 1
+            result = (project_id, count)
+        except Exception as e:
+            result = e
+        self.results.put(((index, None), result))
+
+    def scan_service_account(self, index, account_index, project_id, account):
+        """ Resolve the SA roles and whether any of them has the key creation permission """
+        if self.stopped.is_set():
+            return
+        try:
+            all_roles, has_key_permission = self.gcp_project_enumerator.evaluate_service_account(project_id, account)
+            result = (project_id, account, all_roles, has_key_permission)
+        except Exception as e:
+            result = e
+        self.results.put(((index, account_index), result))
+
+    def iter_service_accounts(self, project_ids, on_project_done=None):
+        """ Yield (project_id, account, roles, has_key_permission) in project order and then service account order.
+        project_ids may be a lazy iterator, the work on the first projects starts while the next pages are fetched.
+        on_project_done(project_id) is called once all the service accounts of a project were consumed """
+        pending = {}
+        account_counts = {}
+        total_projects, projects_error = None, None
+        index, account_index = 0, 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            producer = threading.Thread(target=self.submit_projects, args=(project_ids, pool), daemon=True)
+            producer.start()
+            try:
+                while True:
+                    if total_projects is not None and index >= total_projects:
+                        if projects_error is not None:
+                            raise projects_error
+                        break
+                    if (index, account_index) in pending:
+                        result = pending.pop((index, account_index))
+                        if isinstance(result, Exception):
+                            raise result
+                        account_index += 1
+                        yield result
+                        continue
+                    if index in account_counts:
+                        if isinstance(account_counts[index], Exception):
+                            raise account_counts[index]
+                        project_id, count = account_counts[index]
+                        if account_index >= count:
+                            if on_project_done is not None:
+                                on_project_done(project_id)
+                            index, account_index = index + 1, 0
+                            continue
+                    key, received = self.results.get()
+                    if key is None:
+                        total_projects, projects_error = received
+                    elif key[1] is None:
+                        account_counts[key[0]] = received
+                    else:
+                        pending[key] = received
+            finally:
+                self.stopped.set()
+                producer.join()
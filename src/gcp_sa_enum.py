@@ -1,26 +1,46 @@
+import fnmatch
 import requests
-from googleapiclient.discovery import build
-from src.private_key_creator import PrivateKeyCreator
+from concurrent.futures import ThreadPoolExecutor
+from src.enumeration_engine import EnumerationEngine, DEFAULT_WORKERS
+from src.private_key_creator import PrivateKeyCreator, DEFAULT_KEY_MANIFEST_FILE
+from src.resource_snapshot import ResourceSnapshot
+from src.role_cache import RolePermissionCache
+from src.transport import Transport
 
 
 
 class ServiceAccountEnumerator:
     """Enumerate GCP Projects and Service Accounts and find roles with iam.serviceAccountKeys.create permission  """
-    def __init__(self, credentials, verbose=False):
+    def __init__(self, credentials, verbose=False, role_cache=None, max_workers=DEFAULT_WORKERS, transport=None,
+                 page_size=None, project_filter=None, project_parent=None, journal=None, key_manifest_file=DEFAULT_KEY_MANIFEST_FILE,
+                 key_store=None, audit=None):
         self.credentials = credentials
-        self.resource_manager_service = build('cloudresourcemanager', 'v1', credentials=self.credentials)
-        self.iam_service = build('iam', 'v1', credentials=self.credentials)
+        self.journal = journal
+        self.audit = audit  # AuditSnapshot of the incremental re-audit
+        self.key_permission_accounts = []  # service accounts with the key creation permission
+        self.deferred_key_accounts = []  # ones whose DWD results of the previous audit may be reused, see create_deferred_keys
+        self.page_size = page_size
+        self.project_filter = project_filter  # fnmatch pattern on the project ID, e.g. prod-*
+        self.project_parent = project_parent  # folders/<ID> or organizations/<ID>
+        self.role_cache = role_cache if role_cache is not None else RolePermissionCache()
+        self.max_workers = max_workers
+        self.transport = transport if transport is not None else Transport(credentials, max_per_host=max_workers)
+        self.snapshot = ResourceSnapshot(self)
+        self.resource_manager_service = self.transport.build('cloudresourcemanager', 'v1')
+        self.iam_service = self.transport.build('iam', 'v1')
         self.user_email = self.get_iam_email_from_token()
-        self.key_creator = PrivateKeyCreator(credentials)
+        self.key_creator = PrivateKeyCreator(credentials, transport=self.transport, manifest_file=key_manifest_file,
+                                             delete_workers=max_workers, key_store=key_store)
         self.verbose = verbose
 
+    def execute(self, request):
+        """Execute an API request through the shared transport (per-thread keep-alive connections, per-host concurrency limit)"""
+        return self.transport.execute(request)
+
     def get_iam_email_from_token(self):
         """Get the email (or SA email identifier) associated with the access token provided in order to check for the user relevant role and permissions"""
         try:
-            response = requests.get(
-                'https://www.googleapis.com/oauth2/v1/tokeninfo?alt=json',
-                headers={'Authorization': f'Bearer {self.credentials.token}'}
-            )
+            response = self.transport.tokeninfo(bearer_token=self.credentials.token)
             response.raise_for_status()
             token_info = response.json()
             # Service Account access tokens return different token parameters, here we use 'azp' (issued_to) to find the matching service account email
@@ -35,83 +55,89 @@ class ServiceAccountEnumerator:
     def find_service_account_email_by_client_id(self, client_id):
         """Find the target service account email by matching the oauth2ClientId and azp values. This function relevant only for SA access tokens"""
         for project_id in self.get_projects():
-            request = self.iam_service.projects().serviceAccounts().list(
-                name='projects/' + project_id,
-            )
-            response = request.execute()
-            if 'accounts' in response:
-                for account in response['accounts']:
+            for account in self.snapshot.service_accounts(project_id):
+                # serviceAccounts().list already returns the oauth2ClientId, the details lookup is only a fallback
+                oauth2_client_id = account.get('oauth2ClientId')
+                if oauth2_client_id is None:
                     sa_details = self.get_service_account_details(account['name'])
-                    if sa_details and sa_details.get('oauth2ClientId') == client_id:
-                        return account['email']
+                    oauth2_client_id = sa_details.get('oauth2ClientId') if sa_details else None
+                if oauth2_client_id == client_id:
+                    return account['email']
         return None
 
     def get_service_account_details(self, service_account_name):
         """Get detailed information about the service account, including the oauth2ClientId. This function relevant only for SA access tokens"""
         request = self.iam_service.projects().serviceAccounts().get(name=service_account_name)
         try:
-            response = request.execute()
+            response = self.execute(request)
             return response
         except Exception as e:
             print(f"Error retrieving service account details: {e}")
             return None
 
-    def get_service_account_roles(self, service_account):
-        """Get the roles on the target Service Account resources from the IAM Policy"""
+    def fetch_service_account_policy(self, service_account):
+        """Fetch the IAM Policy of the target Service Account resource (read through self.snapshot)"""
         request = self.iam_service.projects().serviceAccounts().getIamPolicy(  # Get roles of the target SA
             resource=service_account,
         )
-        response = request.execute()
-        roles = []
-
-        if 'bindings' in response:
-            for binding in response['bindings']:
-                if 'members' in binding:
-                    for member in binding['members']:
-                        # Extract the email or serviceaccount identifier part after the ':' character
-                        _, member_identifier = member.split(':', 1)
-                        # Check if the extracted identifier matches the token user email to understand if it has the role
-                        if member_identifier == self.user_email:
-                            roles.append(binding['role'])
-        return roles
+        return self.execute(request)
 
-    def get_project_roles(self, project_id):
-        """Get Project-level roles of the IAM User/SA from the IAM Policy"""
+    def get_service_account_roles(self, service_account):
+        """Get the roles on the target Service Account resources from the IAM Policy"""
+        # The identifier part after the ':' character of each member is matched against the token user email
+        return self.snapshot.service_account_policy(service_account).roles_for(self.user_email)
+
+    def fetch_project_policy(self, project_id):
+        """Fetch the project IAM Policy (read through self.snapshot)"""
         request = self.resource_manager_service.projects().getIamPolicy(
             resource=project_id,
             body={}
         )
-        response = request.execute()
-        roles = []
-
-        if 'bindings' in response:
-            for binding in response['bindings']:
-                if 'members' in binding:
-                    for member in binding['members']:
-                        # Extract the email or serviceaccount identifier part after the ':' character
-                        _, member_identifier = member.split(':', 1)
-
-                        # Check if the extracted identifier matches the token user email to understand if it has the role
-                        if member_identifier == self.user_email:
-                            roles.append(binding['role'])
-
-        return roles
+        return self.execute(request)
 
+    def get_project_roles(self, project_id):
+        """Get Project-level roles of the IAM User/SA from the IAM Policy"""
+        return self.snapshot.project_policy(project_id).roles_for(self.user_email)
+
+    def iter_pages(self, collection, request, stage):
+        """Yield the responses of a paginated list request lazily following the nextPageToken"""
+        while request is not None:
+            with self.transport.metrics.stage(stage):
+                response = self.execute(request)
+            yield response
+            request = collection.list_next(previous_request=request, previous_response=response)
+
+    def iter_projects(self):
+        """Yield the target project IDs page by page (read through self.snapshot)"""
+        list_kwargs = {}
+        if self.page_size:
+            list_kwargs['pageSize'] = self.page_size
+        if self.project_parent:
+            # Resource Manager v1 filters on the direct parent only
+            parent_collection, parent_id = self.project_parent.split('/', 1)
+            parent_type = {'folders': 'folder', 'organizations': 'organization'}.get(parent_collection)
+            if parent_type is None:
+                raise ValueError(f"Invalid project parent {self.project_parent}, expected folders/<ID> or organizations/<ID>")
+            list_kwargs['filter'] = f"parent.type:{parent_type} parent.id:{parent_id}"
+        projects = self.resource_manager_service.projects()
+        request = projects.list(**list_kwargs) # Get list of target projects
+        for response in self.iter_pages(projects, request, 'project_enumeration'):
+            for project in response.get('projects', []):
+                if self.project_filter and not fnmatch.fnmatch(project['projectId'], self.project_filter):
+                    continue
+                yield project['projectId']
 
     def get_projects(self):
         try:
-            request = self.resource_manager_service.projects().list() # Get list of target projects
-            response = request.execute()
-            return [project['projectId'] for project in response['projects']]
+            yield from self.snapshot.projects()
 
         except Exception as e:
             print(f"Failed to get projects: {e}")
             raise e
 
 
-    def check_permission(self, role):
-        """ Check if the target role has iam.serviceAccountKeys.create permission """
-
+    def fetch_role_permissions(self, role):
+        """ Fetch the includedPermissions of the role definition from the IAM API """
         # custom role validation - custom roles starting with the following format projects/<project_name>
         if "projects/" in role:
             request = self.iam_service.projects().roles().get(name=role)
@@ -119,31 +145,103 @@ class ServiceAccountEnumerator:
         else:
             request = self.iam_service.roles().get(name=role)
 
-        response = request.execute()
-        permissions = response.get('includedPermissions', [])
+        response = self.execute(request)
+        return response.get('includedPermissions', [])
+
+    def check_permission(self, role):
+        """ Check if the target role has iam.serviceAccountKeys.create permission (role definitions are resolved once per run via the role cache) """
+        permissions = self.role_cache.get(role, self.fetch_role_permissions)
         return 'iam.serviceAccountKeys.create' in permissions
 
+    def iter_service_accounts(self, project_id):
+        """Yield the service accounts of the target project page by page (read through self.snapshot)"""
+        list_kwargs = {'pageSize': self.page_size} if self.page_size else {}
+        service_accounts = self.iam_service.projects().serviceAccounts()
+        request = service_accounts.list(name='projects/' + project_id, **list_kwargs)
+        for response in self.iter_pages(service_accounts, request, 'service_account_enumeration'):
+            yield from response.get('accounts', [])
+
+    def list_service_accounts(self, project_id):
+        """List the service accounts of the target project"""
+        return self.snapshot.service_accounts(project_id)
+
+    def evaluate_service_account(self, project_id, account):
+        """Resolve the project and SA roles of the IAM User/SA and whether any of them has the key creation permission.
+        Decisions recorded in the journal of a previous run are reused without API calls"""
+        if self.journal is not None:
+            record = self.journal.get_service_account(account['name'])
+            if record is not None:
+                return record['roles'], record['has_key_permission']
+        with self.transport.metrics.stage('service_account_enumeration'):
+            project_roles = self.get_project_roles(project_id)
+            service_account_roles = self.get_service_account_roles(account['name'])
+            all_roles = sorted(set(project_roles + service_account_roles))
+            has_key_permission = any(self.check_permission(role) for role in all_roles)
+        if self.journal is not None:
+            self.journal.record_service_account(account, all_roles, has_key_permission)
+        return all_roles, has_key_permission
+
+    def create_key(self, account):
+        """Create a private key for the SA, unless the key store already holds one (created by a previous run, resumed or
+        kept with DWD by the persistent key storage)"""
+        key_path = self.key_creator.key_store.key_path(account['name'])
+        if key_path in self.key_creator.key_store:
+            print(f"\033[92m \tKey already created in a previous run: {key_path} \033[0m")
+            if self.journal is not None:
+                self.journal.record_key(account['name'], key_path)
+            return
+        with self.transport.metrics.stage('key_creation'):
+            key_path = self.key_creator.create_service_account_key(account['name'])
+        if key_path and self.journal is not None:
+            self.journal.record_key(account['name'], key_path)
+
     def enumerate_service_accounts(self):
+        """Find service accounts with key creation permission, the API calls and the key creations are fanned out to pools of max_workers threads"""
         any_service_account_with_key_permission = False
-        for project_id in self.get_projects():
-            request = self.iam_service.projects().serviceAccounts().list(name='projects/' + project_id)
-            response = request.execute()
-            if 'accounts' in response:
-                for account in response['accounts']:
-                    project_roles = self.get_project_roles(project_id)
-                    service_account_roles = self.get_service_account_roles(account['name'])
-                    all_roles = list(set(project_roles + service_account_roles))
-                    if any(self.check_permission(role) for role in all_roles):
-                        self.print_service_account_details(account, all_roles)
-                        self.key_creator.create_service_account_key(account['name'])
-                        any_service_account_with_key_permission = True
-                    elif self.verbose:
-                        self.print_service_account_details(account)
-                        print('\033[91m' + '\tNo relevant roles found' + '\033[0m')
-                        print('---')
+        engine = EnumerationEngine(self, max_workers=self.max_workers)
+        project_ids = self.get_projects()
+        on_project_done = None
+        if self.journal is not None:
+            if self.key_creator.key_store.persistent:
+                # projects completed in a previous run are skipped, their keys were saved by the key store. A project whose
+                # key creations didn't all finish (crash, failed or deferred creation) is listed again
+                key_store = self.key_creator.key_store
+                project_ids = (project_id for project_id in project_ids if not self.journal.is_project_done(project_id, key_store))
+            # otherwise the keys held in memory are lost, the projects are listed again to re-create them (the SA decisions come from the journal)
+            on_project_done = self.journal.record_project
+        with ThreadPoolExecutor(max_workers=self.max_workers) as key_pool:  # keys.create calls are paced by the iam.keys rate limit
+            for project_id, account, all_roles, has_key_permission in engine.iter_service_accounts(project_ids, on_project_done):
+                if has_key_permission:
+                    self.print_service_account_details(account, all_roles)
+                    self.key_permission_accounts.append(account)
+                    if self.audit is not None:
+                        self.audit.track_service_account(account)
+                    if self.audit is not None and self.audit.previous_dwd(account) is not None:
+                        # the subjects are only known after the enumeration, see create_deferred_keys
+                        self.deferred_key_accounts.append(account)
+                    else:
+                        key_pool.submit(self.create_key, account)
+                    any_service_account_with_key_permission = True
+                elif self.verbose:
+                    self.print_service_account_details(account)
+                    print('\033[91m' + '\tNo relevant roles found' + '\033[0m')
+                    print('---')
         if not any_service_account_with_key_permission:
             print("No GCP Service Accounts roles found with the relevant key permissions")
 
+    def create_deferred_keys(self, subjects, scopes, confirm=False):
+        """Create the keys of the service accounts whose DWD results of the previous audit don't cover all the subject and scope
+        combinations, returns the number of service accounts fully covered by the previous audit"""
+        covered = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as key_pool:
+            for account in self.deferred_key_accounts:
+                if self.audit.covers(account, subjects, scopes, confirm=confirm):
+                    covered += 1
+                else:
+                    key_pool.submit(self.create_key, account)
+        self.deferred_key_accounts = []
+        return covered
+
     def print_service_account_details(self, account, roles=None):
         print('Name: ' + account['name'])
         print('Email: ' + account['email'])
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+
+DEFAULT_JOURNAL_FILE = 'results/journal.jsonl'
+
+
+class ProgressJournal:
+    """ Append-only JSONL journal of the run progress: enumerated projects, service account decisions,
+    created keys and tested (key, subject, scope) combinations. A resumed run loads it to skip the completed work,
+    the records of the current run are only appended to the file """
+    def __init__(self, journal_file=DEFAULT_JOURNAL_FILE, resume=False):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.projects = set()
+        self.service_accounts = {}  # service account name -> record
+        self.key_accounts = {}  # project ID -> names of its service accounts with the key creation permission
+        self.keys = {}  # service account name -> local key path
+        self.combinations = {}  # (key path, subject, scope) -> valid
+
+        directory = os.path.dirname(self.journal_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if resume:
+            self.load()
+        self.file = open(self.journal_file, 'a' if resume else 'w')
+        self.append('run', resumed=resume, started_at=int(time.time()))
+
+    def load(self):
+        if not os.path.exists(self.journal_file):
+            print(f"\033[91m [!] No journal found at {self.journal_file}, starting from scratch \033[0m")
+            return
+        with open(self.journal_file, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # partially written last line of a crashed run
+                self.apply(record)
+        print(f"[+] Resuming from {self.journal_file}: {len(self.projects)} projects, {len(self.service_accounts)} service accounts, "
+              f"{len(self.keys)} keys and {len(self.combinations)} JWT combinations already done")
+
+    def apply(self, record):
+        record_type = record.get('type')
+        if record_type == 'project':
+            self.projects.add(record['project_id'])
+        elif record_type == 'service_account':
+            self.service_accounts[record['name']] = record
+            if record['has_key_permission']:
+                # projects/{PROJECT_ID}/serviceAccounts/{EMAIL}
+                self.key_accounts.setdefault(record['name'].split('/')[1], set()).add(record['name'])
+        elif record_type == 'key':
+            self.keys[record['service_account']] = record['key_path']
+        elif record_type == 'combination':
+            self.combinations[(record['key_path'], record['subject'], record['scope'])] = record['valid']
+
+    def append(self, record_type, **fields):
+        record = dict(type=record_type, **fields)
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def record_project(self, project_id):
+        self.append('project', project_id=project_id)
+
+    def record_service_account(self, account, roles, has_key_permission):
+        self.append('service_account', name=account['name'], email=account.get('email'), roles=roles,
+                    has_key_permission=has_key_permission)
+
+    def record_key(self, service_account, key_path):
+        self.append('key', service_account=service_account, key_path=key_path)
+
+    def record_combination(self, key_path, subject, scope, valid, reason=None):
+        self.append('combination', key_path=key_path, subject=subject, scope=scope, valid=valid, reason=reason)
+
+    def is_project_done(self, project_id, key_store):
+        """ Whether a previous run completed the project: it was fully enumerated and the keys of its service accounts
+        with the key creation permission were all created and are still in the key store """
+        if project_id not in self.projects:
+            return False
+        return all(self.keys.get(name) in key_store for name in self.key_accounts.get(project_id, ()))
+
+    def get_service_account(self, name):
+        return self.service_accounts.get(name)
+
+    def get_key(self, service_account):
+        """ Path of the key created for the service account in a previous run """
+        return self.keys.get(service_account)
+
+    def get_combination(self, key_path, subject, scope):
+        """ True/False when the combination was already tested, None otherwise """
+        return self.combinations.get((key_path, subject, scope))
+
+    def valid_combinations(self):
+        return [combination for combination, valid in self.combinations.items() if valid]
+
+    def close(self):
+        with self.lock:
+            self.file.close()
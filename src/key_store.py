@@ -0,0 +1,175 @@
+""" In-memory store of the created service account keys, optionally persisted (encrypted) to the keys directory.
+
+    python -m src.key_store decrypt SA_private_keys/<key>.json.enc > key.json
+"""
+import base64
+import getpass
+import json
+import os
+import sys
+import threading
+
+from google.auth import crypt
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+except ImportError:  # only needed by the encrypted storage
+    Fernet = None
+
+KEY_STORAGE_MEMORY = 'memory'  # private keys never touch the disk
+KEY_STORAGE_ENCRYPTED = 'encrypted'  # keys also saved to the keys directory, encrypted with a passphrase
+KEY_STORAGE_PLAIN = 'plain'  # keys also saved to the keys directory as service account JSON files
+KEY_STORAGES = (KEY_STORAGE_MEMORY, KEY_STORAGE_ENCRYPTED, KEY_STORAGE_PLAIN)
+DEFAULT_KEYS_DIRECTORY = 'SA_private_keys'
+ENCRYPTED_SUFFIX = '.enc'
+SALT_FILE = '.salt'
+KDF_ITERATIONS = 480000
+
+
+def derive_fernet_key(passphrase, salt):
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=KDF_ITERATIONS)
+    return base64.urlsafe_b64encode(kdf.derive(passphrase.encode('utf-8')))
+
+
+def load_salt(directory, create=True):
+    """ Salt of the passphrase derivation, shared by all the key files of the directory """
+    path = os.path.join(directory, SALT_FILE)
+    if create and not os.path.exists(path):
+        with open(path, 'wb') as file:
+            file.write(os.urandom(16))
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+class KeyRecord:
+    """ Compact record of a created key: the identity fields needed to mint JWTs and its RSA signer, parsed once.
+    The PEM private key is kept to load the signer in the signing processes """
+    __slots__ = ('key_path', 'service_account', 'name', 'client_email', 'token_uri', 'project_id', 'private_key_id', 'private_key', 'signer')
+
+    def __init__(self, key_path, service_account, name, key_data):
+        self.key_path = key_path  # stable identifier of the key in the results, the journal and the manifest
+        self.service_account = service_account
+        self.name = name  # remote resource name projects/{PROJECT_ID}/serviceAccounts/{EMAIL}/keys/{KEY_ID}
+        self.client_email = key_data['client_email']
+        self.token_uri = key_data['token_uri']
+        self.project_id = key_data.get('project_id')
+        self.private_key_id = key_data.get('private_key_id')
+        self.private_key = key_data['private_key']
+        self.signer = crypt.RSASigner.from_service_account_info(key_data)
+
+
+class KeyStore:
+    """ Thread-safe store of the created keys shared by the key creator, the OAuth enumerator and the cleanup.
+    The keys are held in memory, the memory storage keeps the private keys off the disk """
+    def __init__(self, storage=KEY_STORAGE_MEMORY, directory=DEFAULT_KEYS_DIRECTORY, passphrase=None):
+        if storage not in KEY_STORAGES:
+            raise ValueError(f"Unknown key storage {storage}, expected one of {', '.join(KEY_STORAGES)}")
+        self.storage = storage
+        self.directory = directory
+        self.records = {}  # key path -> KeyRecord
+        self.lock = threading.Lock()
+        self.fernet = None
+        if self.persistent:
+            os.makedirs(self.directory, exist_ok=True)
+        if storage == KEY_STORAGE_ENCRYPTED:
+            if Fernet is None:
+                raise ValueError("The encrypted key storage requires the cryptography package (pip install cryptography)")
+            if not passphrase:
+                raise ValueError("The encrypted key storage requires a passphrase")
+            self.fernet = Fernet(derive_fernet_key(passphrase, load_salt(self.directory)))
+        if self.persistent:
+            self.load()
+
+    @property
+    def persistent(self):
+        return self.storage != KEY_STORAGE_MEMORY
+
+    def key_path(self, service_account):
+        file_name = service_account.replace('/', '_').replace(':', '_')
+        return os.path.join(self.directory, f"{file_name}.json")
+
+    def file_path(self, key_path):
+        return key_path + ENCRYPTED_SUFFIX if self.storage == KEY_STORAGE_ENCRYPTED else key_path
+
+    def load(self):
+        """ Load the keys persisted by a previous run (resumed run or keys kept with DWD) """
+        suffix = '.json' + ENCRYPTED_SUFFIX if self.storage == KEY_STORAGE_ENCRYPTED else '.json'
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(suffix):
+                continue
+            file_path = os.path.join(self.directory, file_name)
+            try:
+                with open(file_path, 'rb') as file:
+                    data = file.read()
+                if self.fernet is not None:
+                    try:
+                        data = self.fernet.decrypt(data)
+                    except InvalidToken:
+                        print(f"\033[91m [!] Can't decrypt {file_path}, wrong passphrase? \033[0m")
+                        continue
+                key_data = json.loads(data)
+                key_path = file_path[:-len(ENCRYPTED_SUFFIX)] if self.fernet is not None else file_path
+                service_account = f"projects/{key_data['project_id']}/serviceAccounts/{key_data['client_email']}"
+                record = KeyRecord(key_path, service_account, f"{service_account}/keys/{key_data['private_key_id']}", key_data)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"The service account file {file_path} is not valid: {e}")
+                continue
+            self.records[key_path] = record
+
+    def add(self, service_account, name, key_data):
+        """ Store a created key (the decoded service account JSON), returns its record """
+        record = KeyRecord(self.key_path(service_account), service_account, name, key_data)
+        if self.persistent:
+            data = json.dumps(key_data).encode('utf-8')
+            if self.fernet is not None:
+                data = self.fernet.encrypt(data)
+            file_path = self.file_path(record.key_path)
+            with open(os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as file:
+                file.write(data)
+        with self.lock:
+            self.records[record.key_path] = record
+        return record
+
+    def get(self, key_path):
+        with self.lock:
+            return self.records.get(key_path)
+
+    def remove(self, key_path):
+        """ Forget the key and delete its persisted file, returns the removed file path (None if it wasn't persisted) """
+        with self.lock:
+            self.records.pop(key_path, None)
+        file_path = self.file_path(key_path)
+        if self.persistent and os.path.exists(file_path):
+            os.remove(file_path)
+            return file_path
+        return None
+
+    def snapshot(self):
+        """ Current records, safe to iterate while keys are added or removed """
+        with self.lock:
+            return list(self.records.values())
+
+    def __contains__(self, key_path):
+        with self.lock:
+            return key_path in self.records
+
+    def __len__(self):
+        with self.lock:
+            return len(self.records)
+
+
+def decrypt_key_file(path, passphrase):
+    with open(path, 'rb') as file:
+        data = file.read()
+    return Fernet(derive_fernet_key(passphrase, load_salt(os.path.dirname(path) or '.', create=False))).decrypt(data).decode('utf-8')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'decrypt':
+        sys.exit(f"usage: python -m src.key_store decrypt <key file{ENCRYPTED_SUFFIX}>")
+    if Fernet is None:
+        sys.exit("The cryptography package is required (pip install cryptography)")
+    passphrase = os.environ.get('DELEFRIEND_KEY_PASSPHRASE') or getpass.getpass('Key store passphrase: ')
+    print(decrypt_key_file(sys.argv[2], passphrase))
@@ -0,0 +1,207 @@
+import bisect
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """ Fixed bucket latency histogram (milliseconds) """
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, milliseconds):
+        self.counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction):
+        """ Upper bound of the bucket holding the given percentile """
+        threshold = fraction * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold and count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return 0.0
+
+    def to_dict(self):
+        labels = [f'<={bucket}' for bucket in self.buckets] + [f'>{self.buckets[-1]}']
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 3) if self.count else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'max_ms': round(self.max, 3),
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class Metrics:
+    """ Run instrumentation: API calls by endpoint and status, latency histograms and stage durations.
+    Stage timers accumulate, so a stage measured from several worker threads reports its total busy time """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.api_calls = Counter()  # (endpoint, status) -> calls
+        self.latencies = {}  # endpoint -> LatencyHistogram
+        self.stages = {}  # stage -> {'seconds', 'count'}
+        self.gauges = {}  # e.g. rate_limit.iam -> current requests/s
+        self.current_stage = None
+        self.live_summary_stop = threading.Event()
+        self.live_summary_thread = None
+
+    def record_call(self, endpoint, status, seconds):
+        with self.lock:
+            self.api_calls[(endpoint, status)] += 1
+            histogram = self.latencies.get(endpoint)
+            if histogram is None:
+                histogram = self.latencies[endpoint] = LatencyHistogram()
+            histogram.observe(seconds * 1000.0)
+
+    @contextmanager
+    def api_call(self, endpoint):
+        """ Time an API call, the status is taken from the yielded dict (set 'status' before leaving the block) """
+        call = {'status': 'error'}
+        started_at = time.perf_counter()
+        try:
+            yield call
+        finally:
+            self.record_call(endpoint, call['status'], time.perf_counter() - started_at)
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_stage_time(self, stage, seconds):
+        with self.lock:
+            entry = self.stages.setdefault(stage, {'seconds': 0.0, 'count': 0})
+            entry['seconds'] += seconds
+            entry['count'] += 1
+
+    @contextmanager
+    def stage(self, stage, current=False):
+        """ Time a stage; current=True marks it as the stage shown by the live summary """
+        if current:
+            self.current_stage = stage
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, time.perf_counter() - started_at)
+
+    def summary(self):
+        with self.lock:
+            calls = sum(self.api_calls.values())
+            errors = sum(count for (_, status), count in self.api_calls.items() if status != 200)
+            current_rates = sorted((name.split('.', 1)[1], value) for name, value in self.gauges.items() if name.startswith('rate_limit.'))
+        elapsed = time.monotonic() - self.started_at
+        rate = calls / elapsed if elapsed > 0 else 0.0
+        rate_limits = ', '.join(f'{api} {value}/s' for api, value in current_rates)
+        return f"[metrics] stage: {self.current_stage or '-'} - {calls} API calls ({errors} non-200) - {rate:.1f} calls/s - rate limits: {rate_limits}"
+
+    def to_dict(self):
+        with self.lock:
+            api_calls = {}
+            for (endpoint, status), count in sorted(self.api_calls.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+                api_calls.setdefault(endpoint, {})[str(status)] = count
+            return {
+                'elapsed_seconds': round(time.monotonic() - self.started_at, 3),
+                'api_calls': api_calls,
+                'latency': {endpoint: histogram.to_dict() for endpoint, histogram in sorted(self.latencies.items())},
+                'stages': {stage: {'seconds': round(entry['seconds'], 3), 'count': entry['count']}
+                           for stage, entry in self.stages.items()},
+                'gauges': dict(sorted(self.gauges.items())),
+            }
+
+    def print_summary(self):
+        data = self.to_dict()
+        print(f"\n[+] Run metrics ({data['elapsed_seconds']:.1f}s):")
+        for stage, entry in data['stages'].items():
+            print(f"  \t{stage:<28}{entry['seconds']:>10.2f}s  ({entry['count']}x)")
+        for endpoint, statuses in data['api_calls'].items():
+            latency = data['latency'][endpoint]
+            counts = ', '.join(f'{status}: {count}' for status, count in statuses.items())
+            print(f"  \t{endpoint:<52} {counts}  p50 {latency['p50_ms']}ms  p95 {latency['p95_ms']}ms")
+
+    def export(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+        print(f"[+] Saving metrics to {path} ...")
+
+    def start_live_summary(self, interval=10.0):
+        def report():
+            while not self.live_summary_stop.wait(interval):
+                print(self.summary())
+        self.live_summary_thread = threading.Thread(target=report, daemon=True)
+        self.live_summary_thread.start()
+
+    def stop_live_summary(self):
+        self.live_summary_stop.set()
+        if self.live_summary_thread is not None:
+            self.live_summary_thread.join()
+
+
+class TimedSigner:
+    """ google.auth.crypt.Signer wrapper measuring the RSA signing time of the JWT assertions """
+    def __init__(self, signer, metrics):
+        self.signer = signer
+        self.metrics = metrics
+
+    @property
+    def key_id(self):
+        return self.signer.key_id
+
+    def sign(self, message):
+        started_at = time.perf_counter()
+        try:
+            return self.signer.sign(message)
+        finally:
+            self.metrics.add_stage_time('jwt_signing', time.perf_counter() - started_at)
+
+
+class ThreadProfiler:
+    """ cProfile of the main thread and of every thread started while it is enabled, merged into one dump """
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start_thread_profile(self, *args):
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return  # another profiler is already active on this thread
+        with self.lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self.start_thread_profile)
+        self.start_thread_profile()
+
+    def dump(self, path):
+        threading.setprofile(None)
+        stats = None
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+            try:
+                stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+            except TypeError:
+                continue  # a thread which never ran profiled code
+        if stats is not None:
+            stats.dump_stats(path)
+            print(f"[+] Saving cProfile dump to {path} ...")
@@ -1,28 +1,64 @@
 from google.oauth2 import service_account
-from google.auth.transport.requests import Request
-from google.auth.exceptions import DefaultCredentialsError, RefreshError
+from google.auth.exceptions import DefaultCredentialsError, RefreshError, TransportError
+from concurrent.futures import ThreadPoolExecutor
+from src.assertion_signer import AssertionSigner, SignedAssertion, DEFAULT_SIGNING_PROCESSES
 from src.domain_users_enum import DomainUserEnumerator
+from src.metrics import TimedSigner
+from src.progress import ProgressReporter
+from src.results_writer import ResultsWriter
+from src.transport import MAX_RETRIES, RETRYABLE_STATUS_CODES, backoff_delay
 import requests
-import os
+import threading
+import time
 
-KEY_FOLDER = 'SA_private_keys'
+DEFAULT_VALIDATION_WORKERS = 16
+SEARCH_MODE_FULL = 'full'  # collect the full scope map of each key
+SEARCH_MODE_CONFIRM = 'confirm'  # stop testing a key after its first valid scope
+SEARCH_MODES = (SEARCH_MODE_FULL, SEARCH_MODE_CONFIRM)
+VALIDATION_MODE_EXCHANGE = 'exchange'  # DWD decided from the token exchange response alone
+VALIDATION_MODE_TOKENINFO = 'tokeninfo'  # every issued token is also checked against tokeninfo (granted scope)
+VALIDATION_MODES = (VALIDATION_MODE_EXCHANGE, VALIDATION_MODE_TOKENINFO)
+FAILURE_TOKENINFO = 'tokeninfo_rejected'  # token issued but not confirmed by tokeninfo
+
+
+def refresh_error_reason(error):
+    """ OAuth error code and description of a refused token exchange (google.auth RefreshError): unauthorized_client when the
+    client ID isn't delegated the scope, access_denied when the delegation is refused for the subject, invalid_grant for an
+    invalid subject (unknown user/domain) or JWT (e.g. deleted key). Transient errors (429/5xx) are retried before getting here """
+    response_data = error.args[1] if len(error.args) > 1 else None
+    if isinstance(response_data, dict) and response_data.get('error'):
+        return response_data['error'], response_data.get('error_description', '')
+    return 'refresh_error', str(error)
+
+
+class RetryableValidationError(Exception):
+    """ Transient token endpoint / tokeninfo failure (429, 5xx or connection error) """
 
 class OAuthEnumerator:
     """ Creates access token to each private key, OAuth scope, and distinct org email and validate whether they have DWD enabled"""
-    def __init__(self, gcp_project_enumerator, workspace_user_email, scopes_file, key_folder, verbose=False):
+    def __init__(self, gcp_project_enumerator, workspace_user_email, scopes_file, verbose=False, max_workers=DEFAULT_VALIDATION_WORKERS,
+                 search_mode=SEARCH_MODE_FULL, priority_file=None, journal=None, signing_processes=DEFAULT_SIGNING_PROCESSES,
+                 validation_mode=VALIDATION_MODE_EXCHANGE, results_writer=None):
         self.gcp_project_enumerator = gcp_project_enumerator
+        self.transport = gcp_project_enumerator.transport  # connection pools shared by all the validation workers
+        self.key_creator = gcp_project_enumerator.key_creator
+        self.key_store = self.key_creator.key_store  # keys created by the enumeration, held in memory
+        self.audit = gcp_project_enumerator.audit  # DWD results of the previous audit in an incremental run
         self.workspace_user_email = workspace_user_email
         self.scopes_file = scopes_file
-        self.key_folder = key_folder
-        self.scopes = self.read_scopes_from_file()
-        self.valid_results = {}
+        self.search_mode = search_mode
+        self.priority_file = priority_file
+        self.scopes = self.rank_scopes(self.read_scopes_from_file())
+        self.results_writer = results_writer if results_writer is not None else ResultsWriter(key_files=self.key_store.persistent)  # findings are streamed, not kept
+        self.validation_mode = validation_mode
         self.verbose = verbose
-        self.confirmed_dwd_keys = []  # Keep track of keys with DWD
+        self.confirmed_dwd_keys = set()  # Keep track of keys with DWD
+        self.max_workers = max(1, max_workers)
+        self.signing_processes = signing_processes  # 0 signs the JWT assertions in the validation threads
+        self.results_lock = threading.Lock()
+        self.journal = journal
         self.user_emails = self.get_org_emails()
 
-    def get_valid_results(self):
-        return self.valid_results
-
     def read_scopes_from_file(self):
         """ read OAuth scopes list from oauth_scopes.txt"""
         try:
@@ -36,6 +72,57 @@ class OAuthEnumerator:
             print(f"An error occurred while reading the scopes file: {e}")
             return []
 
+    def rank_scopes(self, scopes):
+        """ Order the scopes so that the ones listed in the priority file (most commonly delegated first) are tried first """
+        if not self.priority_file:
+            return scopes
+        try:
+            with open(self.priority_file, 'r') as file:
+                priority = [line.strip() for line in file if line.strip()]
+        except OSError as e:
+            print(f"Scopes priority file couldn't be read, keeping the scopes file order: {e}")
+            return scopes
+        rank = {scope: index for index, scope in enumerate(priority)}
+        return sorted(scopes, key=lambda scope: rank.get(scope, len(rank)))
+
+    def is_key_done(self, json_path):
+        """ In confirm mode a key is done as soon as one valid scope was found for it """
+        return self.search_mode == SEARCH_MODE_CONFIRM and json_path in self.confirmed_dwd_keys
+
+    def is_combination_done(self, json_path, user_email, scope):
+        """ Whether the combination was already tested in a previous run (resumed from the journal or in the previous audit) """
+        if self.journal is not None and self.journal.get_combination(json_path, user_email, scope) is not None:
+            return True
+        if self.audit is not None:
+            record = self.key_store.get(json_path)
+            return record is not None and self.audit.get_result(record.service_account, user_email, scope) is not None
+        return False
+
+    def restore_from_journal(self):
+        """ Reload the valid combinations found by a previous run into the results and confirmed_dwd_keys """
+        for json_path, user_email, scope in self.journal.valid_combinations():
+            if json_path in self.key_store:
+                self.record_valid_result(json_path, user_email, scope, source='journal')
+
+    def restore_from_audit(self):
+        """ Reload the valid scopes of the previous audit for the service accounts whose client ID didn't change """
+        for account in self.gcp_project_enumerator.key_permission_accounts:
+            json_path = self.key_store.key_path(account['name'])
+            for user_email, scopes in self.audit.valid_results(account['name']).items():
+                if user_email not in self.user_emails:
+                    continue
+                for scope in scopes:
+                    if scope not in self.scopes:
+                        continue
+                    # no key is created for a service account covered by the previous audit
+                    key_path = json_path if json_path in self.key_store else None
+                    self.results_writer.record_finding(account['name'], account['email'], account.get('projectId'), key_path,
+                                                       user_email, scope, source='previous_audit')
+                    if json_path in self.key_store:
+                        with self.results_lock:
+                            self.confirmed_dwd_keys.add(json_path)
+                        self.key_creator.mark_dwd(json_path)
+
     def get_org_emails(self):
         """ Initialize user emails based on the provided workspace_user_email in config or via enumeration IAM roles on GCP projects """
         if self.workspace_user_email:
@@ -47,62 +134,185 @@ class OAuthEnumerator:
             domain_user_enumerator.print_unique_domain_users()
             return list(unique_users.values())
 
+    def load_key_credentials(self, record):
+        """ Credentials of a stored key, its RSA signer is wrapped to measure the signing time of the JWT assertions """
+        signer = TimedSigner(record.signer, self.transport.metrics)
+        return service_account.Credentials(signer, record.client_email, record.token_uri, project_id=record.project_id)
+
     def jwt_creator(self):
-        """ Create JWT objects for each combination of workspace distinct org email, OAuth scope, and private key pair  """
-        jwt_objects = []
-        for json_file in os.listdir(self.key_folder):
-            json_path = os.path.join(self.key_folder, json_file)
+        """ Lazily yield JWT objects for each combination of workspace distinct org email, OAuth scope, and private key pair.
+        The keys come from the key store with their RSA signer already loaded, the scoped/delegated copies share the same signer """
+        for record in self.key_store.snapshot():
+            json_path = record.key_path
+            with self.transport.metrics.stage('jwt_minting'):
+                key_creds = self.load_key_credentials(record)
 
             for user_email in self.user_emails:
+                subject_creds = key_creds.with_subject(user_email)
                 for scope in self.scopes:
-                    creds = service_account.Credentials.from_service_account_file(
-                        json_path,
-                        scopes=[scope],
-                    )
-                    creds = creds.with_subject(user_email)
-                    jwt_objects.append((json_path, user_email, scope, creds))
-
-        return jwt_objects
-
-    def token_validator(self, jwt_objects):
-        """ Validate access tokens for each JWT object combination  """
-        for json_path, user_email, scope, creds in jwt_objects:
+                    creds = subject_creds.with_scopes([scope])
+                    yield json_path, user_email, scope, creds
+
+    def jwt_combinations(self):
+        """ Lazily yield the (key record, subject, scope) combinations to sign in the signing processes """
+        for record in self.key_store.snapshot():
+            for user_email in self.user_emails:
+                for scope in self.scopes:
+                    yield record, user_email, scope
+
+    def key_label(self, json_path):
+        """ Key file path when the key storage saves it, the service account email otherwise (the file never exists) """
+        if self.key_store.persistent:
+            return json_path
+        record = self.key_store.get(json_path)
+        return record.client_email if record is not None else json_path
+
+    def is_skipped(self, json_path, user_email, scope):
+        return self.is_key_done(json_path) or self.is_combination_done(json_path, user_email, scope)
+
+    def record_valid_result(self, json_path, user_email, scope, source='tested'):
+        """ Stream a valid (key, subject, scope) combination to the results, called concurrently by the validation workers.
+        Returns False when it is dropped, the key being already confirmed in confirm mode """
+        with self.results_lock:
+            if self.is_key_done(json_path):
+                return False
+            self.confirmed_dwd_keys.add(json_path)
+        self.key_creator.mark_dwd(json_path)  # kept even if the run is interrupted before the cleanup
+        record = self.key_store.get(json_path)
+        self.results_writer.record_finding(record.service_account, record.client_email, record.project_id, json_path,
+                                           user_email, scope, source=source)
+        if source == 'tested':
+            print(f"\033[92m [+] Token is valid for {self.key_label(json_path)} with scope {scope} \033[0m")
+        return True
+
+    def record_failure(self, json_path, reason):
+        record = self.key_store.get(json_path)
+        self.results_writer.record_failure(record.client_email, record.project_id, json_path, reason)
+
+    def confirm_with_tokeninfo(self, creds, scope):
+        """ Whether tokeninfo confirms the issued access token and its granted scope """
+        response = self.transport.tokeninfo(access_token=creds.token)
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise RetryableValidationError(f"tokeninfo returned {response.status_code}")
+        if response.status_code != 200:
+            return False
+        granted_scopes = response.json().get('scope')
+        return granted_scopes is None or scope in granted_scopes.split()
+
+    def validate_combination(self, json_path, user_email, scope, creds):
+        """ Exchange the JWT for an access token, retrying transient errors with backoff. Token endpoint 429/5xx are retried by a
+        single loop: here for the pre-signed assertions (google-auth retries disabled), by google-auth for the in-thread Credentials.
+        An issued token means the delegation holds, tokeninfo is only called in the tokeninfo validation mode.
+        Returns (valid, failure reason), valid is None when it couldn't be determined """
+        for attempt in range(MAX_RETRIES + 1):
+            if self.is_key_done(json_path):
+                return None, None
             try:
-                creds.refresh(Request())
-                token_info_url = f"https://www.googleapis.com/oauth2/v1/tokeninfo?access_token={creds.token}"
-                response = requests.get(token_info_url)
+                try:
+                    creds.refresh(self.transport.auth_request)
+                    confirmed = self.validation_mode != VALIDATION_MODE_TOKENINFO or self.confirm_with_tokeninfo(creds, scope)
+                except (TransportError, requests.RequestException) as e:
+                    raise RetryableValidationError(str(e))
+                except RefreshError as e:
+                    if getattr(e, 'retryable', False):
+                        if isinstance(creds, SignedAssertion):  # exchanged with can_retry=False, only retried here
+                            raise RetryableValidationError(str(e))
+                        # service_account.Credentials.refresh already retried it with the google-auth backoff
+                        print(f"\033[91m [!] Giving up on {self.key_label(json_path)} with scope {scope}: {e} \033[0m")
+                        return None, None
+                    raise
 
-                if response.status_code == 200:
-                    self.valid_results.setdefault(json_path, []).append(scope)
-                    print(f"\033[92m [+] Token is valid for {json_path} with scope {scope} \033[0m")
-                    if json_path not in self.confirmed_dwd_keys:
-                        self.confirmed_dwd_keys.append(json_path)
+                if confirmed:
+                    if not self.record_valid_result(json_path, user_email, scope):
+                        return None, None  # confirmed concurrently by another scope, not reported so not recorded either
+                    return True, None
+                self.record_failure(json_path, FAILURE_TOKENINFO)
+                return False, FAILURE_TOKENINFO
 
+            except RetryableValidationError as e:
+                if attempt == MAX_RETRIES:
+                    print(f"\033[91m [!] Giving up on {self.key_label(json_path)} with scope {scope} after {MAX_RETRIES} retries: {e} \033[0m")
+                    return None, None
+                time.sleep(backoff_delay(attempt))
             except DefaultCredentialsError:
                 print("The service account file is not valid or doesn't exist.")
+                return None, None
             except RefreshError as e:
+                reason, description = refresh_error_reason(e)
+                self.record_failure(json_path, reason)
                 if self.verbose:
-                    print(f"[-] Invalid or expired token with scope {scope}")
+                    print(f"[-] No delegation for {self.key_label(json_path)} as {user_email} with scope {scope}: {reason} {description}")
+                return False, reason
+
+    def token_validator(self, jwt_objects, total=None):
+        """ Validate access tokens for each JWT object combination on a pool of max_workers threads. jwt_objects is consumed lazily """
+        progress = ProgressReporter(total if total is not None else len(jwt_objects))
+        # bound the number of queued combinations so that lazily generated JWT objects aren't all materialized
+        in_flight = threading.BoundedSemaphore(self.max_workers * 2)
+
+        def validate(combination):
+            skipped = False
+            try:
+                if self.is_key_done(combination[0]):
+                    skipped = True  # the key was confirmed while the combination was queued (confirm mode)
+                    return
+                valid, reason = self.validate_combination(*combination)
+                if valid is not None and self.journal is not None:
+                    self.journal.record_combination(combination[0], combination[1], combination[2], valid, reason=reason)
+                if valid is not None and self.audit is not None:
+                    self.audit.record_result(self.key_store.get(combination[0]).service_account, combination[1], combination[2], valid)
+            except Exception as e:
+                print(f"\033[91m [!] An error occurred while validating {self.key_label(combination[0])} with scope {combination[2]}: {e} \033[0m")
+            finally:
+                in_flight.release()
+                progress.advance(skipped=skipped)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for combination in jwt_objects:
+                if self.is_skipped(*combination[:3]):
+                    progress.advance(skipped=True)
+                    continue
+                in_flight.acquire()
+                pool.submit(validate, combination)
 
     def total_jwt_combinations(self):
         """ calculate total combinations of JWT based on the number of enumerated OAuth scopes, GCP private keys pairs and target workspace org emails
         (oauth_scopes.txt number * private key pairs * target workspace org (distinct) emails)"""
         num_scopes = len(self.scopes)
-        num_keys = len(os.listdir(self.key_folder))
+        num_keys = len(self.key_store)
         num_emails = len(self.user_emails)
         return num_scopes * num_keys * num_emails
 
 
-    def run(self):
+    def run(self, search_mode=None):
+        """ Enumerate the JWT combinations, search_mode (full/confirm) overrides the mode given to the constructor """
+        if search_mode is not None:
+            self.search_mode = search_mode
         if not self.scopes:
             print('\033[91m'+ '[!] No scopes to check. Exiting.' + '\033[0m')
             return
 
-        if not os.path.exists(self.key_folder) or not os.listdir(self.key_folder):
-            print('\033[91m' + '[!] No GCP private key pairs were found. It might suggest the IAM user doesn’t have permission to create keys on target Service Accounts. Try to use different GCP identity' + '\033[0m')
+        covered = 0
+        if self.audit is not None:
+            # only the service accounts, subjects and scopes which the previous audit didn't test need a key
+            covered = self.gcp_project_enumerator.create_deferred_keys(self.user_emails, self.scopes,
+                                                                       confirm=self.search_mode == SEARCH_MODE_CONFIRM)
+            self.restore_from_audit()
+            if covered:
+                print(f"  \t [+] {covered} service accounts are fully covered by the DWD results of the previous audit")
+
+        if not len(self.key_store):
+            if not covered:
+                print('\033[91m' + '[!] No GCP private key pairs were found. It might suggest the IAM user doesn’t have permission to create keys on target Service Accounts. Try to use different GCP identity' + '\033[0m')
             return
 
+        if self.journal is not None:
+            self.restore_from_journal()
         total_combinations = self.total_jwt_combinations()
-        print(f"  \t [+] Total of JWT combinations to enumerate: {total_combinations}!")
-        jwt_objects = self.jwt_creator()
-        self.token_validator(jwt_objects)
+        print(f"  \t [+] Total of JWT combinations to enumerate: {total_combinations}! (search mode: {self.search_mode}, validation mode: {self.validation_mode})")
+        if self.signing_processes <= 0:
+            self.token_validator(self.jwt_creator(), total_combinations)
+            return
+        # RSA signing runs in a process pool, the validation threads only exchange the pre-signed assertions
+        with AssertionSigner(self.key_store.snapshot(), self.signing_processes, metrics=self.transport.metrics) as signer:
+            self.token_validator(signer.sign(self.jwt_combinations(), skip=self.is_skipped), total_combinations)
@@ -1,37 +1,130 @@
 import os
 import json
-from googleapiclient.discovery import build
+import atexit
 import base64
+import queue
+import signal
+import threading
+import time
+from googleapiclient.errors import HttpError
+from src.key_store import KeyStore
+from src.transport import Transport
+
+DEFAULT_KEY_MANIFEST_FILE = 'results/key_manifest.jsonl'
+DEFAULT_DELETE_WORKERS = 8
+
+
+def run_in_threads(items, func, workers):
+    """ Call func(item) for each item on plain worker threads. Unlike ThreadPoolExecutor it still works from atexit handlers """
+    work = queue.Queue()
+    for item in items:
+        work.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except queue.Empty:
+                return
+            func(item)
+
+    threads = []
+    for _ in range(min(workers, work.qsize())):
+        thread = threading.Thread(target=worker, daemon=True)
+        try:
+            thread.start()
+        except RuntimeError:
+            break  # no new threads at interpreter shutdown, the current thread drains the queue
+        threads.append(thread)
+    worker()
+    for thread in threads:
+        thread.join()
+
 
 class PrivateKeyCreator:
-    """ Creates GCP private key pairs for SAs with permissions """
-    def __init__(self, credentials):
+    """ Creates GCP private key pairs for SAs with permissions and manages their lifecycle: every created key is tracked
+    in memory and in a JSONL manifest, so the keys without DWD can be deleted in bulk, even when the run is interrupted.
+    The key material itself is held by the key store """
+    def __init__(self, credentials, transport=None, manifest_file=DEFAULT_KEY_MANIFEST_FILE, delete_workers=DEFAULT_DELETE_WORKERS,
+                 key_store=None):
         self.credentials = credentials
-        self.iam_service = build('iam', 'v1', credentials=self.credentials)
-        self.keys_directory = "SA_private_keys"
-        os.makedirs(self.keys_directory, exist_ok=True)
+        self.transport = transport if transport is not None else Transport(credentials)
+        self.iam_service = self.transport.build('iam', 'v1')
+        self.key_store = key_store if key_store is not None else KeyStore()
+        self.manifest_file = manifest_file
+        self.delete_workers = max(1, delete_workers)
+        self.lock = threading.Lock()
+        self.keys = {}  # remote key resource name -> local key path, for the keys which still exist
+        self.key_files = {}  # local key path -> resource name of the key it currently holds
+        self.dwd_keys = set()  # local key paths confirmed with DWD, kept at cleanup
+        self.cleaned_up = False
+        self.manifest = None
+        if self.manifest_file:
+            self.load_manifest()
+
+    def load_manifest(self):
+        """ Track the keys a previous run created but didn't delete (interrupted run or failed deletion) """
+        directory = os.path.dirname(self.manifest_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # partially written last line of a crashed run
+                    if record.get('event') in ('created', 'deleted', 'kept'):
+                        self.apply(record['event'], record['key_path'], record['name'])
+            if self.keys:
+                print(f"\033[93m [!] {len(self.keys)} service account keys of a previous run weren't deleted, they will be cleared with the keys of this run \033[0m")
+        self.manifest = open(self.manifest_file, 'a')
 
+    def apply(self, event, key_path, name):
+        if event == 'created':
+            self.keys[name] = key_path
+            self.key_files[key_path] = name  # an older key of the same path stays tracked, only remotely
+        else:
+            self.keys.pop(name, None)
+            if self.key_files.get(key_path) == name:
+                del self.key_files[key_path]
+
+    def record(self, event, key_path, name):
+        with self.lock:
+            self.apply(event, key_path, name)
+            if self.manifest is not None and not self.manifest.closed:
+                self.manifest.write(json.dumps({'event': event, 'key_path': key_path, 'name': name, 'at': int(time.time())}) + '\n')
+                self.manifest.flush()
 
     def create_service_account_key(self, service_account):
+        """ Create a new private key for the service account and add it to the key store, returns the key path (None on failure) """
         try:
-            key = self.iam_service.projects().serviceAccounts().keys().create(
+            key = self.transport.execute(self.iam_service.projects().serviceAccounts().keys().create(
                 name=service_account,
                 body={
                     "keyAlgorithm": "KEY_ALG_RSA_2048",
                     "privateKeyType": "TYPE_GOOGLE_CREDENTIALS_FILE",
                 }
-            ).execute()
+            ))
 
             # The private key data is a base64-encoded JSON string within the attr privateKeyData
             key_json = base64.b64decode(key['privateKeyData']).decode('utf-8')
             key_data = json.loads(key_json)
 
-            file_name = service_account.replace('/', '_').replace(':', '_')
-            file_path = os.path.join(self.keys_directory, f"{file_name}.json")
-            with open(file_path, "w") as file:
-                json.dump(key_data, file)  # Save the decoded key data, not the entire key object
+            # track the remote key before anything else can fail, so that it is always cleared
+            key_path = self.key_store.key_path(service_account)
+            previous = self.key_store.get(key_path)
+            if previous is not None and previous.name != key['name']:
+                # the stored key of a previous run is overwritten, it is tracked again to be deleted at cleanup
+                self.record('created', key_path, previous.name)
+            self.record('created', key_path, key['name'])
+            record = self.key_store.add(service_account, key['name'], key_data)
 
-            print(f"\033[92m \tKey created and saved to {file_path} \033[0m")
+            if self.key_store.persistent:
+                print(f"\033[92m \tKey created and saved to {self.key_store.file_path(record.key_path)} \033[0m")
+            else:
+                print(f"\033[92m \tKey created: {record.name} \033[0m")
+            return record.key_path
 
         except Exception as e:
             if "Precondition check failed." in str(e):
@@ -42,32 +135,103 @@ class PrivateKeyCreator:
             else:
                 print(f"\033[91m  [!] An error occurred while creating service account key: {e} \033[0m")
 
+    def mark_dwd(self, key_path):
+        """ Keep the key at cleanup, DWD was confirmed for it """
+        with self.lock:
+            self.dwd_keys.add(key_path)
+
     def delete_remote_key(self, key_name):
-        """ Delete the remote service account key """
+        """ Delete the remote service account key, returns whether it is gone """
         try:
-            self.iam_service.projects().serviceAccounts().keys().delete(name=key_name).execute()
+            self.transport.execute(self.iam_service.projects().serviceAccounts().keys().delete(name=key_name))
             print(f" \033[92m [+] Successfully deleted remote service account key: {key_name} \033[0m")
+            return True
+        except HttpError as e:
+            if e.resp.status == 404:
+                return True  # already deleted
+            print(f"\033[91m Error deleting remote key {key_name}: {e} \033[0m")
         except Exception as e:
             print(f"\033[91m Error deleting remote key {key_name}: {e} \033[0m")
+        return False
+
+    def keys_to_delete(self):
+        """ Tracked keys and stored keys which weren't confirmed with DWD, as resource name -> key path.
+        Keys held in memory only can't be used after the run, so the DWD ones are deleted as well """
+        with self.lock:
+            keys = dict(self.keys)
+            key_files = dict(self.key_files)
+            dwd_keys = set(self.dwd_keys) if self.key_store.persistent else set()
+        for record in self.key_store.snapshot():
+            if record.key_path not in key_files:  # e.g. a key kept by a previous run
+                keys[record.name] = record.key_path
+                key_files[record.key_path] = record.name
+        return {name: key_path for name, key_path in keys.items()
+                if key_path not in dwd_keys or key_files.get(key_path) != name}
+
+    def delete_key(self, name, key_path, failed):
+        """ Delete the key remotely, then from the key store unless the store holds a newer key of the same path """
+        if not self.delete_remote_key(name):
+            failed.append(name)  # the local key is kept as well, the next run retries it from the manifest
+            return
+        with self.lock:
+            holds_key = self.key_files.get(key_path, name) == name
+        self.record('deleted', key_path, name)
+        if not holds_key:
+            return
+        try:
+            file_path = self.key_store.remove(key_path)
+            if file_path:
+                print(f" \033[92m [+] Deleted local service account key without DWD: {file_path}  \033[0m")
+        except OSError as e:
+            print(f"Error deleting {key_path}: {e}")
 
-    def delete_keys_without_dwd(self, confirmed_dwd_keys):
-        """ Delete SA keys which found without DWD from local folder and remotely"""
+    def delete_keys_without_dwd(self, confirmed_dwd_keys=()):
+        """ Delete the SA keys which were found without DWD, remotely and from the key store, on delete_workers threads.
+        Returns the resource names of the keys which couldn't be deleted """
         print("\n\n[+] Clearing private keys without DWD enabled ...")
-        for key_path in os.listdir(self.keys_directory):
-            full_path = os.path.join(self.keys_directory, key_path)
-            if full_path not in confirmed_dwd_keys:
-                try:
-                    # Delete the key remotely
-                    with open(full_path, 'r') as key_file:
-                        key_data = json.load(key_file)
-                        client_email = key_data["client_email"]
-                        key_id = key_data["private_key_id"]
-                        project_id = key_data["project_id"]
-                        # API is expecting the following format projects/{PROJECT_ID}/serviceAccounts/{SERVICE_ACCOUNT_EMAIL}/keys/{KEY_ID}
-                        resource_name = f"projects/{project_id}/serviceAccounts/{client_email}/keys/{key_id}"
-                        self.delete_remote_key(resource_name)
-                    # Delete the key locally
-                    os.remove(full_path)
-                    print(f" \033[92m [+] Deleted local service account key without DWD: {full_path}  \033[0m")
-                except OSError as e:
-                    print(f"Error deleting {full_path}: {e}")
\ No newline at end of file
+        for key_path in confirmed_dwd_keys:
+            self.mark_dwd(key_path)
+        if self.dwd_keys and not self.key_store.persistent:
+            print("\033[93m [!] The keys are held in memory only, the keys with DWD are deleted as well (set key_storage to encrypted or plain to keep them) \033[0m")
+        keys = self.keys_to_delete()
+        failed = []
+        run_in_threads(keys.items(), lambda key: self.delete_key(key[0], key[1], failed), self.delete_workers)
+        with self.lock:
+            kept = [(key_path, name) for key_path, name in self.key_files.items() if key_path in self.dwd_keys and self.key_store.persistent]
+        for key_path, name in kept:
+            self.record('kept', key_path, name)
+        self.cleaned_up = True
+        if failed:
+            print(f"\033[91m [!] Failed to delete {len(failed)} service account keys, delete them manually (they are retried on the next run):")
+            for name in sorted(failed):
+                print(f"\t{name}")
+            print("\033[0m", end='')
+        return failed
+
+    def cleanup_on_exit(self):
+        """ Clear the keys without confirmed DWD when the run ends before the cleanup stage """
+        if self.cleaned_up:
+            return
+        with self.lock:
+            pending = [name for name, key_path in self.keys.items()
+                       if key_path not in self.dwd_keys or self.key_files.get(key_path) != name or not self.key_store.persistent]
+        if pending:
+            print(f"\n\033[93m [!] Run interrupted, deleting {len(pending)} created keys without confirmed DWD ... \033[0m")
+            self.delete_keys_without_dwd()
+        self.cleaned_up = True
+
+    def install_exit_cleanup(self):
+        """ Run cleanup_on_exit at interpreter exit, also on SIGTERM/SIGHUP (SIGINT already exits through KeyboardInterrupt) """
+        atexit.register(self.cleanup_on_exit)
+
+        def exit_on_signal(signum, frame):
+            raise SystemExit(128 + signum)
+
+        for signal_name in ('SIGTERM', 'SIGHUP'):
+            if hasattr(signal, signal_name):
+                signal.signal(getattr(signal, signal_name), exit_on_signal)
+
+    def close(self):
+        with self.lock:
+            if self.manifest is not None:
+                self.manifest.close()
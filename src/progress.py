@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+class ProgressReporter:
+    """ Thread-safe progress counter which periodically prints the completion rate and ETA. Skipped items (already done
+    by a previous run) count toward the completion but not toward the rate """
+    def __init__(self, total, label='JWT combinations', interval=5.0):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.skipped = 0
+        self.started_at = time.monotonic()
+        self.last_report = self.started_at
+        self.lock = threading.Lock()
+
+    def advance(self, count=1, skipped=False):
+        with self.lock:
+            self.done += count
+            if skipped:
+                self.skipped += count
+            now = time.monotonic()
+            if now - self.last_report < self.interval and self.done < self.total:
+                return
+            self.last_report = now
+            done, skipped, elapsed = self.done, self.skipped, now - self.started_at
+        self.report(done, skipped, elapsed)
+
+    def report(self, done, skipped, elapsed):
+        rate = (done - skipped) / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - done, 0)
+        eta = format_duration(remaining / rate) if rate else '?'
+        percent = 100.0 * done / self.total if self.total else 100.0
+        skipped_note = f", {skipped} skipped" if skipped else ''
+        print(f"  \t [*] {done}/{self.total} {self.label} ({percent:.1f}%{skipped_note}) - {rate:.1f}/s - ETA {eta}")
@@ -0,0 +1,125 @@
+import threading
+import time
+
+# requests per second, the default ceilings of each budget are derived from the per-minute API quotas
+DEFAULT_RATE_LIMITS = {
+    'iam': 100.0,  # IAM read requests
+    'iam.keys': 10.0,  # IAM write requests (service account keys create/delete)
+    'cloudresourcemanager': 20.0,
+    'oauth2': 100.0,  # OAuth token endpoint
+    'tokeninfo': 100.0,
+}
+MIN_RATE_RATIO = 0.05  # the rate never drops below this share of the ceiling
+RECOVERY_SECONDS = 20.0  # time to climb from 0 back to the ceiling without throttling
+THROTTLE_COOLDOWN = 2.0  # seconds, 429s within this window only decrease the rate once
+
+
+class TokenBucket:
+    """ Thread-safe token bucket whose rate adapts to throttling (AIMD): halved on a 429, then increased linearly
+    with the successful traffic back up to the ceiling """
+    def __init__(self, name, max_rate, on_rate_change=None):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = max_rate * MIN_RATE_RATIO
+        self.rate = max_rate
+        self.increase_step = max_rate / RECOVERY_SECONDS  # requests/s gained per second at full speed
+        self.on_rate_change = on_rate_change
+        self.capacity = max(1.0, max_rate)  # allow one second of burst
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a request may be sent """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return
+                    wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            if self.rate >= self.max_rate:
+                return
+            self.rate = min(self.max_rate, self.rate + self.increase_step / self.rate)
+            rate = self.rate
+        self.notify(rate)
+
+    def on_throttle(self, retry_after=None):
+        """ Decrease the rate and honor the Retry-After delay (seconds) of a 429/RESOURCE_EXHAUSTED response """
+        with self.lock:
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if now - self.last_decrease < THROTTLE_COOLDOWN:
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self.tokens = min(self.tokens, 1.0)
+            rate = self.rate
+        self.notify(rate)
+
+    def notify(self, rate):
+        if self.on_rate_change is not None:
+            self.on_rate_change(self.name, rate)
+
+
+class RateLimiter:
+    """ Central rate limiter with a separate adaptive budget for each API (IAM, Resource Manager, OAuth token endpoint...) """
+    def __init__(self, rate_limits=None, metrics=None):
+        limits = dict(DEFAULT_RATE_LIMITS)
+        limits.update(rate_limits or {})
+        self.metrics = metrics
+        self.buckets = {name: TokenBucket(name, float(rate), on_rate_change=self.rate_changed) for name, rate in limits.items()}
+        for name, bucket in self.buckets.items():
+            self.rate_changed(name, bucket.rate)
+
+    @staticmethod
+    def api_for_method(method_id):
+        """ Budget name of a discovery method ID, e.g. iam.projects.serviceAccounts.list -> iam """
+        if method_id.startswith('iam.projects.serviceAccounts.keys.'):
+            return 'iam.keys'
+        return method_id.split('.', 1)[0]
+
+    def bucket(self, api):
+        return self.buckets.get(api) or self.buckets.get(api.split('.', 1)[0])
+
+    def acquire(self, api):
+        bucket = self.bucket(api)
+        if bucket is not None:
+            bucket.acquire()
+
+    def record(self, api, status, retry_after=None):
+        """ Feed the response status back to the budget of the API """
+        bucket = self.bucket(api)
+        if bucket is None:
+            return
+        if status == 429:
+            bucket.on_throttle(retry_after)
+        elif status is not None and status < 500:
+            bucket.on_success()  # any other answer (e.g. 401 unauthorized_client) means the request wasn't throttled
+
+    def rate_changed(self, api, rate):
+        if self.metrics is not None:
+            self.metrics.set_gauge(f'rate_limit.{api}', round(rate, 2))
+
+    def rates(self):
+        return {name: bucket.rate for name, bucket in self.buckets.items()}
+
+
+def parse_retry_after(value):
+    """ Retry-After header in seconds (HTTP dates aren't used by the Google APIs) """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
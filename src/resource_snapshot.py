@@ -0,0 +1,72 @@
+import threading
+
+
+class IamPolicy:
+    """ IAM policy response with the bindings indexed by member for O(1) membership checks """
+    def __init__(self, response):
+        self.etag = response.get('etag')
+        self.bindings = response.get('bindings', [])
+        self.roles_by_member = {}  # full member, e.g. user:alice@domain.com -> roles
+        self.roles_by_identity = {}  # member identifier after the ':' character -> roles
+        for binding in self.bindings:
+            for member in binding.get('members', []):
+                identity = member.split(':', 1)[-1]
+                self.roles_by_member.setdefault(member, []).append(binding['role'])
+                self.roles_by_identity.setdefault(identity, []).append(binding['role'])
+
+    def roles_for(self, identity):
+        return list(self.roles_by_identity.get(identity, []))
+
+
+class ResourceSnapshot:
+    """ Per-run snapshot of the GCP resources shared by the enumerators. Each project list, project IAM policy,
+    service account list and service account IAM policy is fetched exactly once, even with concurrent readers.
+    Paginated lists are streamed to the first reader page by page and served from memory afterwards """
+    def __init__(self, gcp_project_enumerator):
+        self.gcp_project_enumerator = gcp_project_enumerator
+        self.cache = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def key_lock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def get_or_fetch(self, key, fetch):
+        if key in self.cache:
+            return self.cache[key]
+        with self.key_lock(key):
+            if key not in self.cache:
+                self.cache[key] = fetch()
+        return self.cache[key]
+
+    def get_or_stream(self, key, iterate):
+        """ Yield the items of a paginated list, fetching them lazily on the first read only. Other readers of the
+        same key wait for the stream to complete; an abandoned stream isn't cached """
+        if key in self.cache:
+            yield from self.cache[key]
+            return
+        with self.key_lock(key):
+            if key not in self.cache:
+                items = []
+                for item in iterate():
+                    items.append(item)
+                    yield item
+                self.cache[key] = items
+                return
+        yield from self.cache[key]
+
+    def projects(self):
+        return self.get_or_stream(('projects',), self.gcp_project_enumerator.iter_projects)
+
+    def project_policy(self, project_id):
+        return self.get_or_fetch(('project_policy', project_id),
+                                 lambda: IamPolicy(self.gcp_project_enumerator.fetch_project_policy(project_id)))
+
+    def service_accounts(self, project_id):
+        return self.get_or_stream(('service_accounts', project_id),
+                                  lambda: self.gcp_project_enumerator.iter_service_accounts(project_id))
+
+    def service_account_policy(self, service_account):
+        return self.get_or_fetch(('service_account_policy', service_account),
+                                 lambda: IamPolicy(self.gcp_project_enumerator.fetch_service_account_policy(service_account)))
@@ -0,0 +1,146 @@
+import csv
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+DEFAULT_RESULTS_FOLDER = 'results'
+RESULTS_FORMATS = ('jsonl', 'csv')
+FINDING_FIELDS = ('found_at', 'elapsed_seconds', 'project_id', 'service_account', 'service_account_email', 'key_name',
+                  'subject', 'domain', 'scope', 'source')
+
+
+class ResultsWriter:
+    """ Streams each confirmed DWD finding to JSONL/CSV as soon as it is found, and writes at the end an indexed JSON summary
+    by project, service account, domain and scope (and the text report). Only the small indexes are held in memory """
+    def __init__(self, results_folder=DEFAULT_RESULTS_FOLDER, formats=RESULTS_FORMATS, timestamp=None, key_files=False):
+        unknown_formats = set(formats) - set(RESULTS_FORMATS)
+        if unknown_formats:
+            raise ValueError(f"Unknown results formats {', '.join(sorted(unknown_formats))}, expected {', '.join(RESULTS_FORMATS)}")
+        os.makedirs(results_folder, exist_ok=True)
+        self.key_files = key_files  # the keys are saved to files (persistent key storage), otherwise held in memory only
+        self.started_at = time.time()
+        self.base_path = os.path.join(results_folder, f'results_{timestamp or int(self.started_at)}')
+        self.lock = threading.Lock()
+        self.findings = set()  # (service account, subject, scope) already written
+        self.by_project = {}  # project ID -> service account emails
+        self.by_service_account = {}  # email -> {'project_id', 'key_name', 'subjects', 'scopes', 'failures'}
+        self.by_domain = {}  # domain -> {'service_accounts', 'scopes'}
+        self.by_scope = {}  # scope -> service account emails
+        self.jsonl_file = self.csv_file = self.csv_writer = None
+        if 'jsonl' in formats:
+            self.jsonl_file = open(self.base_path + '.jsonl', 'w')
+        if 'csv' in formats:
+            self.csv_file = open(self.base_path + '.csv', 'w', newline='')
+            self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=FINDING_FIELDS)
+            self.csv_writer.writeheader()
+            self.csv_file.flush()
+        print(f"[+] Streaming the DWD findings to {self.base_path}.{{{','.join(formats)}}} ...")
+
+    def key_name(self, key_path):
+        """ Key file name, None when the key was only held in memory or wasn't created (reused previous audit result) """
+        return os.path.basename(key_path) if self.key_files and key_path else None
+
+    def service_account_entry(self, email, project_id, key_name):
+        return self.by_service_account.setdefault(email, {'project_id': project_id, 'key_name': key_name, 'subjects': set(),
+                                                          'scopes': set(), 'failures': Counter()})
+
+    def record_finding(self, service_account, email, project_id, key_path, subject, scope, source='tested'):
+        """ Write a valid (service account, subject, scope) combination, source is tested, journal or previous_audit.
+        Returns False if it was already written """
+        domain = subject.split('@')[-1] if subject else None
+        now = time.time()
+        finding = {
+            'found_at': datetime.fromtimestamp(now, timezone.utc).isoformat(timespec='seconds'),
+            'elapsed_seconds': round(now - self.started_at, 3),
+            'project_id': project_id,
+            'service_account': service_account,
+            'service_account_email': email,
+            'key_name': self.key_name(key_path),
+            'subject': subject,
+            'domain': domain,
+            'scope': scope,
+            'source': source,
+        }
+        with self.lock:
+            if (service_account, subject, scope) in self.findings:
+                return False
+            self.findings.add((service_account, subject, scope))
+            entry = self.service_account_entry(email, project_id, finding['key_name'])
+            entry['subjects'].add(subject)
+            entry['scopes'].add(scope)
+            self.by_project.setdefault(project_id, set()).add(email)
+            domain_entry = self.by_domain.setdefault(domain, {'service_accounts': set(), 'scopes': set()})
+            domain_entry['service_accounts'].add(email)
+            domain_entry['scopes'].add(scope)
+            self.by_scope.setdefault(scope, set()).add(email)
+            if self.jsonl_file is not None:
+                self.jsonl_file.write(json.dumps(finding) + '\n')
+                self.jsonl_file.flush()
+            if self.csv_writer is not None:
+                self.csv_writer.writerow(finding)
+                self.csv_file.flush()
+        return True
+
+    def record_failure(self, email, project_id, key_path, reason):
+        """ Count a refused combination of the service account by OAuth error code """
+        with self.lock:
+            self.service_account_entry(email, project_id, self.key_name(key_path))['failures'][reason] += 1
+
+    def summary(self, scope_order=()):
+        rank = {scope: index for index, scope in enumerate(scope_order)}
+
+        def ordered(scopes):
+            return sorted(scopes, key=lambda scope: (rank.get(scope, len(rank)), scope))
+
+        with self.lock:
+            return {
+                'started_at': datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(timespec='seconds'),
+                'elapsed_seconds': round(time.time() - self.started_at, 3),
+                'totals': {'findings': len(self.findings), 'projects': len(self.by_project),
+                           'service_accounts': sum(1 for entry in self.by_service_account.values() if entry['scopes']),
+                           'domains': len(self.by_domain), 'scopes': len(self.by_scope)},
+                'by_project': {project_id: sorted(emails) for project_id, emails in sorted(self.by_project.items())},
+                'by_service_account': {email: {'project_id': entry['project_id'], 'key_name': entry['key_name'],
+                                               'subjects': sorted(entry['subjects']), 'scopes': ordered(entry['scopes']),
+                                               'failures': dict(entry['failures'].most_common())}
+                                       for email, entry in sorted(self.by_service_account.items())},
+                'by_domain': {domain: {'service_accounts': sorted(entry['service_accounts']), 'scopes': ordered(entry['scopes'])}
+                              for domain, entry in sorted(self.by_domain.items())},
+                'by_scope': {scope: sorted(self.by_scope[scope]) for scope in ordered(self.by_scope)},
+            }
+
+    def report_header(self, email, entry):
+        if entry['key_name']:
+            return f"Service Account Key Name: {entry['key_name']}\n"
+        return f"Service Account: {email}\n"  # no key file was written
+
+    def write_text_report(self, summary):
+        with open(self.base_path + '.txt', 'w') as f:
+            for email, entry in summary['by_service_account'].items():
+                if entry['scopes']:
+                    f.write(self.report_header(email, entry))
+                    f.write('Valid OAuth Scopes:\n')
+                    for scope in entry['scopes']:
+                        f.write(f'{scope}\n')
+                    f.write('---\n')
+            for email, entry in summary['by_service_account'].items():
+                if not entry['scopes'] and entry['failures']:
+                    f.write(self.report_header(email, entry))
+                    f.write('No DWD: ' + ', '.join(f'{reason} x{count}' for reason, count in entry['failures'].items()) + '\n')
+                    f.write('---\n')
+
+    def close(self, scope_order=()):
+        """ Close the streams and write the indexed summary JSON and the text report """
+        with self.lock:
+            for file in (self.jsonl_file, self.csv_file):
+                if file is not None and not file.closed:
+                    file.close()
+        summary = self.summary(scope_order)
+        with open(self.base_path + '_summary.json', 'w') as file:
+            json.dump(summary, file, indent=2)
+        self.write_text_report(summary)
+        print(f"\n\n[+] Saving results to {self.base_path}.txt and the indexed summary to {self.base_path}_summary.json ...")
+        return summary
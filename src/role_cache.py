@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+
+DEFAULT_TTL = 7 * 24 * 3600  # built-in role definitions change rarely
+BUILTIN_ROLE_PREFIX = 'roles/'  # custom roles (projects/*/roles/*, organizations/*/roles/*) can be edited at any time
+
+
+class RolePermissionCache:
+    """ Cache of role name -> includedPermissions (frozenset) shared for the whole run. Built-in roles are optionally
+    persisted to disk with a TTL, custom roles are resolved once per run """
+    def __init__(self, cache_file=None, ttl=DEFAULT_TTL):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.permissions = {}
+        self.fetched_at = {}
+        self.lock = threading.Lock()
+        self.role_locks = {}  # concurrent misses on the same role wait for a single fetch
+        if self.cache_file:
+            self.load()
+
+    def load(self):
+        """ Load non-expired role definitions from the cache file """
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"\033[91m [!] Ignoring unreadable role cache {self.cache_file}: {e} \033[0m")
+            return
+        now = time.time()
+        for role, entry in data.get('roles', {}).items():
+            if role.startswith(BUILTIN_ROLE_PREFIX) and now - entry.get('fetched_at', 0) < self.ttl:
+                self.permissions[role] = frozenset(entry.get('permissions', []))
+                self.fetched_at[role] = entry['fetched_at']
+
+    def save(self):
+        """ Persist the cached built-in role definitions """
+        if not self.cache_file:
+            return
+        with self.lock:
+            data = {'roles': {role: {'fetched_at': self.fetched_at[role], 'permissions': sorted(permissions)}
+                              for role, permissions in self.permissions.items() if role.startswith(BUILTIN_ROLE_PREFIX)}}
+        directory = os.path.dirname(self.cache_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.cache_file + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.cache_file)
+
+    def get(self, role, fetch):
+        """ Return the permissions of the role, calling fetch(role) -> iterable of permissions only on a cache miss """
+        with self.lock:
+            permissions = self.permissions.get(role)
+            role_lock = self.role_locks.setdefault(role, threading.Lock())
+        if permissions is not None:
+            return permissions
+        with role_lock:
+            with self.lock:
+                permissions = self.permissions.get(role)
+            if permissions is not None:
+                return permissions
+            permissions = frozenset(fetch(role))
+            with self.lock:
+                self.permissions[role] = permissions
+                self.fetched_at[role] = time.time()
+        return permissions
+
+    def __contains__(self, role):
+        return role in self.permissions
+
+    def __len__(self):
+        return len(self.permissions)
@@ -0,0 +1,132 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import httplib2
+import requests
+from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from requests.adapters import HTTPAdapter
+from src.metrics import Metrics
+from src.rate_limiter import RateLimiter, parse_retry_after
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_TIMEOUT = 60  # seconds
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+MAX_RETRIES = 5
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# a non-idempotent call may have succeeded server-side despite a 500/502/504 (a retried keys.create would leak the first key),
+# it is only retried when the request was rejected before being processed
+NON_IDEMPOTENT_METHODS = ('iam.projects.serviceAccounts.keys.create',)
+NON_IDEMPOTENT_RETRYABLE_STATUS_CODES = (429, 503)
+
+
+def backoff_delay(attempt, base=1.0, cap=32.0):
+    """ Exponential backoff with full jitter """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class HostLimiter:
+    """ Bound the number of in-flight API requests per host (e.g. iam.googleapis.com) """
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, uri):
+        host = urlparse(uri).netloc
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if semaphore is None:
+                semaphore = self.semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+        with semaphore:
+            yield
+
+
+class Transport:
+    """ Shared keep-alive HTTP layer used by all the worker threads: a pooled requests session for the OAuth token
+    endpoint and tokeninfo, and per-thread persistent httplib2 connections for the discovery clients """
+    def __init__(self, credentials=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, max_per_host=None,
+                 api_endpoints=None, tokeninfo_url=TOKENINFO_URL, metrics=None, rate_limits=None):
+        self.credentials = credentials
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.rate_limiter = RateLimiter(rate_limits, metrics=self.metrics)  # shared by all the API clients
+        self.timeout = timeout
+        self.api_endpoints = api_endpoints or {}  # service name -> root URL override, e.g. for a local mock backend
+        self.tokeninfo_url = tokeninfo_url
+        self.host_limiter = HostLimiter(max_per_host or pool_size)
+        self.thread_local = threading.local()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.google_request = Request(session=self.session)
+
+    def auth_request(self, url, method='GET', body=None, headers=None, **kwargs):
+        """ google.auth transport callable for creds.refresh(), reusing the pooled session connections """
+        kwargs.setdefault('timeout', self.timeout)
+        self.rate_limiter.acquire('oauth2')
+        with self.metrics.api_call('oauth2.token') as call:
+            response = self.google_request(url, method=method, body=body, headers=headers, **kwargs)
+            call['status'] = response.status
+        self.rate_limiter.record('oauth2', response.status, parse_retry_after(response.headers.get('Retry-After')))
+        return response
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def tokeninfo(self, access_token=None, bearer_token=None):
+        """ Query tokeninfo for an access token, either as a parameter or as the Authorization bearer token """
+        self.rate_limiter.acquire('tokeninfo')
+        with self.metrics.api_call('oauth2.tokeninfo') as call:
+            if bearer_token:
+                response = self.get(self.tokeninfo_url, params={'alt': 'json'}, headers={'Authorization': f'Bearer {bearer_token}'})
+            else:
+                response = self.get(self.tokeninfo_url, params={'access_token': access_token})
+            call['status'] = response.status_code
+        self.rate_limiter.record('tokeninfo', response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+        return response
+
+    def authorized_http(self):
+        """ Per-thread authorized httplib2 object, httplib2 isn't thread safe but keeps its connections alive """
+        http = getattr(self.thread_local, 'http', None)
+        if http is None:
+            http = self.thread_local.http = AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=self.timeout))
+        return http
+
+    def build(self, service_name, version):
+        """ Build a discovery client, its requests should be run through execute() """
+        api_endpoint = self.api_endpoints.get(service_name)
+        if api_endpoint:
+            return build(service_name, version, credentials=self.credentials, client_options={'api_endpoint': api_endpoint})
+        return build(service_name, version, credentials=self.credentials)
+
+    def execute(self, request):
+        """ Execute a discovery client request on the calling thread connections within the per-host concurrency limit
+        and the API rate limit. 429/RESOURCE_EXHAUSTED and 5xx responses are retried, honoring Retry-After
+        (only 429 and 503 for the non-idempotent methods) """
+        api = RateLimiter.api_for_method(request.methodId)
+        retryable_status_codes = NON_IDEMPOTENT_RETRYABLE_STATUS_CODES if request.methodId in NON_IDEMPOTENT_METHODS else RETRYABLE_STATUS_CODES
+        for attempt in range(MAX_RETRIES + 1):
+            self.rate_limiter.acquire(api)
+            with self.host_limiter.limit(request.uri), self.metrics.api_call(request.methodId) as call:
+                try:
+                    response = request.execute(http=self.authorized_http())
+                except HttpError as e:
+                    status = call['status'] = e.resp.status
+                    self.rate_limiter.record(api, status, parse_retry_after(e.resp.get('retry-after')))
+                    if status not in retryable_status_codes or attempt == MAX_RETRIES:
+                        raise
+                else:
+                    call['status'] = 200
+                    self.rate_limiter.record(api, 200)
+                    return response
+            # 429s are also delayed by the rate limiter pause, the backoff spreads the retries of the other workers
+            time.sleep(backoff_delay(attempt))